@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Storage cost per order of the payload stored with each Order.
+
+Compares, for the example payload in tests/post.json padded to various
+numbers of seats, the size of the full Shopify payload, of the OrderData
+record as plain JSON, and of the record as stored (zlib-compressed).
+
+Run from the repository root:
+
+    python -m benchmarks.payload_storage
+"""
+import copy
+import json
+import os
+
+from edx_shopify.payload import encode_order, decode_order, load_order
+
+PAYLOAD_FILE = os.path.join(os.path.dirname(__file__),
+                            os.pardir, 'tests', 'post.json')
+
+
+def make_payload(payload, seats):
+    "Return a copy of payload with the given number of seats."
+    payload = copy.deepcopy(payload)
+    template = payload['line_items'][0]
+    line_items = []
+    for i in range(seats):
+        item = copy.deepcopy(template)
+        item['properties'] = [{'name': 'email',
+                               'value': 'learner%d@example.com' % i}]
+        line_items.append(item)
+    payload['line_items'] = line_items
+    return payload
+
+
+def main():
+    with open(PAYLOAD_FILE) as f:
+        payload = json.load(f)
+
+    print('%6s %12s %12s %12s %8s' % ('seats', 'full (B)', 'record (B)',
+                                      'stored (B)', 'ratio'))
+    for seats in [1, 2, 10, 100, 1000]:
+        full = make_payload(payload, seats)
+        data = load_order(full)
+        record = json.dumps(list(data), separators=(',', ':'))
+        stored = encode_order(data)
+        assert decode_order(stored) == data
+
+        full_size = len(json.dumps(full, separators=(',', ':')))
+        print('%6d %12d %12d %12d %7.1f%%' % (seats,
+                                              full_size,
+                                              len(record),
+                                              len(stored),
+                                              100.0 * len(stored) / full_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""Query and commit counts, wall time and allocations of
+utils.process_order.
+
+Processes orders of 1, 10, 100 and 1000 seats, either all for one
+course or spread over ten, with get_course_by_id() and enroll_email()
+mocked at realistic latencies. Processing an order must take a number
+of queries that grows with the number of courses in the order, not
+with the number of seats, and a fixed number of commits. So for each
+number of courses, every order must take the same number of commits
+as the smallest order with seats in all of those courses, and at most
+one more query per MIN_SEATS_PER_QUERY more seats (to allow for
+batches of bulk inserts and enrollments); anything else counts as a
+failure. Check with
+
+    python runbenchmarks.py process_order
+
+from the repository root.
+
+SQL query and commit counts are also compared against the baselines
+in baselines.json, if there is one: any increase over a baseline
+counts as a failure too. Baselines must come from an actual run,
+on the database backend to be checked; record them with
+
+    python runbenchmarks.py --update-baselines process_order
+
+and again after a deliberate change in query counts.
+
+Allocations are measured with tracemalloc, so on Python 3 only.
+"""
+import itertools
+import json
+import os
+import time
+
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.test.utils import CaptureQueriesContext
+
+from edx_shopify import utils
+from edx_shopify.cache import course_cache
+from edx_shopify.models import Order
+from edx_shopify.payload import LineItem
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2: allocations are not measured
+    tracemalloc = None
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+SEATS = [1, 10, 100, 1000]
+COURSES = [1, 10]
+
+# Seats that each query beyond those for an order of one seat must
+# cover, at least
+MIN_SEATS_PER_QUERY = 10
+
+# Mocked latencies, in seconds, of loading a course from the
+# modulestore and of enrolling one student
+COURSE_LATENCY = 0.05
+ENROLL_LATENCY = 0.002
+
+order_ids = itertools.count(2000000)
+
+
+def sleeper(latency, return_value=None):
+    "Return a mock that takes latency seconds to return."
+    def side_effect(*args, **kwargs):
+        time.sleep(latency)
+        return return_value
+    return Mock(side_effect=side_effect)
+
+
+class CommitCounter(object):
+    """Count the transactions committed on a connection: explicit
+    commits at the end of atomic blocks, plus writes run in autocommit
+    mode.
+    """
+
+    WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.commits = 0
+
+    def __enter__(self):
+        counter = self
+        execute = CursorWrapper.execute
+        executemany = CursorWrapper.executemany
+        commit = self.connection.commit
+
+        def count_autocommit(sql):
+            write = sql.lstrip().upper().startswith(self.WRITES)
+            if write and not counter.connection.in_atomic_block:
+                counter.commits += 1
+
+        def counting_execute(cursor, sql, *args, **kwargs):
+            count_autocommit(sql)
+            return execute(cursor, sql, *args, **kwargs)
+
+        def counting_executemany(cursor, sql, *args, **kwargs):
+            count_autocommit(sql)
+            return executemany(cursor, sql, *args, **kwargs)
+
+        def counting_commit():
+            counter.commits += 1
+            return commit()
+
+        self.patchers = [
+            patch.object(CursorWrapper, 'execute', counting_execute),
+            patch.object(CursorWrapper, 'executemany', counting_executemany),
+            patch.object(self.connection, 'commit', counting_commit),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+
+
+def make_line_items(seats, courses):
+    "Return seats line items, spread evenly over a number of courses."
+    return [LineItem('course-v1:org+course+run%d' % (i % courses),
+                     'learner%d@example.com' % i)
+            for i in range(seats)]
+
+
+def measure(seats, courses):
+    """Process a new order.
+
+    Return the number of queries, the number of commits, the wall
+    time in seconds, and the peak memory allocated in bytes (or None).
+    """
+    order = Order.objects.create(id=next(order_ids),
+                                 email='janedoe@example.com',
+                                 first_name='Jane',
+                                 last_name='Doe')
+    line_items = make_line_items(seats, courses)
+
+    # Start from a cold course cache, as a worker would for an order
+    # for courses it has not seen yet
+    course_cache.clear()
+
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    with CaptureQueriesContext(connection) as queries, \
+            CommitCounter(connection) as commits:
+        utils.process_order(order, line_items)
+    elapsed = time.time() - start
+    peak = None
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return len(queries), commits.commits, elapsed, peak
+
+
+def check_scaling(seats, queries, commits, reference):
+    """Compare the queries and commits for an order of seats to those
+    for the reference order, the smallest with seats for all of the
+    same courses.
+
+    Return a description of the problem, or an empty string if none.
+    """
+    extra_seats = seats - reference['seats']
+    extra_queries = queries - reference['queries']
+    if commits != reference['commits']:
+        return 'REGRESSION: %d commits for %d seats' % (
+            reference['commits'], reference['seats'])
+    if extra_queries * MIN_SEATS_PER_QUERY > extra_seats:
+        return 'REGRESSION: %d queries for %d seats' % (
+            reference['queries'], reference['seats'])
+    return ''
+
+
+def run(update_baselines=False):
+    all_baselines = {}
+    if os.path.exists(BASELINES_FILE):
+        with open(BASELINES_FILE) as f:
+            all_baselines = json.load(f)
+    baselines = all_baselines.setdefault('process_order', {})
+
+    if not tracemalloc:
+        print('Allocations not measured: tracemalloc needs Python 3.')
+
+    failures = 0
+    print('%6s %8s %8s %10s %8s %10s %10s %12s' % (
+        'seats', 'courses', 'queries', 'baseline', 'commits', 'baseline',
+        'time (s)', 'peak (KiB)'))
+    with patch.multiple(utils,
+                        get_course_by_id=sleeper(COURSE_LATENCY, Mock()),
+                        enroll_email=sleeper(ENROLL_LATENCY)):
+        for courses in COURSES:
+            reference = None
+            for seats in SEATS:
+                key = '%d/%d' % (seats, courses)
+                queries, commits, elapsed, peak = measure(seats, courses)
+                counts = {'queries': queries, 'commits': commits}
+                baseline = baselines.get(key, {})
+                if reference is None and seats >= courses:
+                    reference = dict(counts, seats=seats)
+
+                result = ''
+                if reference is not None:
+                    result = check_scaling(seats, queries, commits,
+                                           reference)
+                if update_baselines:
+                    baselines[key] = counts
+                elif not result and baseline:
+                    regressed = [name for name in sorted(counts)
+                                 if counts[name] > baseline[name]]
+                    if regressed:
+                        result = 'REGRESSION: %s over baseline' % (
+                            ' and '.join(regressed))
+                if result:
+                    failures += 1
+
+                print('%6d %8d %8d %10s %8d %10s %10.3f %12s %s' % (
+                    seats, courses,
+                    queries, baseline.get('queries', '-'),
+                    commits, baseline.get('commits', '-'),
+                    elapsed,
+                    '-' if peak is None else '%.1f' % (peak / 1024.0),
+                    result))
+
+    course_cache.clear()
+
+    if update_baselines:
+        with open(BASELINES_FILE, 'w') as f:
+            json.dump(all_baselines, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
+
+    return failures
@@ -0,0 +1,180 @@
+"""Webhook throughput of views.order_create.
+
+Shopify gives up on a webhook delivery after 5 seconds, and retries it
+later. This benchmark posts signed order payloads with various numbers
+of seats to the webhook, and reports latency percentiles and requests
+per second for each stage:
+
+* client/queued: through the Django test client, with the processing
+  task not run (as when a Celery worker picks it up);
+* client/eager: through the Django test client, with the processing
+  task run eagerly, in the request;
+* wsgi/eager: through a real (wsgiref) WSGI server over HTTP, with the
+  processing task run eagerly.
+
+Enrollment is stubbed out, so the numbers cover this app's own work
+(signature check, parsing, and database writes) but not the LMS's.
+
+Run from the repository root:
+
+    python runbenchmarks.py webhook
+"""
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import threading
+import time
+
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.urlresolvers import reverse
+from django.test import Client, override_settings
+from django.utils.six.moves import http_client
+
+from edx_shopify import tasks, utils
+from edx_shopify.cache import course_cache
+
+from .payload_storage import PAYLOAD_FILE, make_payload
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+SEATS = [1, 10, 100]
+REQUESTS = 200
+
+# Order IDs for the generated payloads, so that every request records
+# a new order
+order_ids = itertools.count(1000000)
+
+
+def percentile(samples, p):
+    "Return the p-th percentile of a sorted list of samples."
+    index = int(round(p / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+def make_request(payload, seats):
+    "Return a new signed (body, headers) webhook request."
+    conf = settings.WEBHOOK_SETTINGS['edx_shopify']
+    payload = make_payload(payload, seats)
+    payload['id'] = next(order_ids)
+    body = json.dumps(payload).encode('utf-8')
+    digest = hmac.new(conf['api_key'].encode('utf-8'),
+                      body,
+                      hashlib.sha256).digest()
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Shopify-Hmac-Sha256': base64.b64encode(digest).decode('ascii'),
+        'X-Shopify-Shop-Domain': conf['shop_domain'],
+    }
+    return body, headers
+
+
+def post_client(client, path, body, headers):
+    "Post a webhook request through the Django test client."
+    meta = dict(('HTTP_%s' % name.upper().replace('-', '_'), value)
+                for name, value in headers.items()
+                if name != 'Content-Type')
+    response = client.post(path, body,
+                           content_type=headers['Content-Type'], **meta)
+    return response.status_code
+
+
+def post_http(address, path, body, headers):
+    "Post a webhook request to a WSGI server over HTTP."
+    conn = http_client.HTTPConnection(*address)
+    try:
+        conn.request('POST', path, body, headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def measure(post, payload, seats):
+    """Post REQUESTS new webhook requests, one at a time.
+
+    Return the sorted latencies in seconds, and the overall requests
+    per second.
+    """
+    requests = [make_request(payload, seats) for i in range(REQUESTS)]
+    latencies = []
+    start = time.time()
+    for body, headers in requests:
+        t = time.time()
+        status = post(body, headers)
+        latencies.append(time.time() - t)
+        assert status == 200, 'Webhook returned %d' % status
+    elapsed = time.time() - start
+    return sorted(latencies), len(requests) / elapsed
+
+
+def report(stage, seats, latencies, rate):
+    print('%-14s %6d %10.1f %10.2f %10.2f %10.2f' % (
+        stage, seats, rate,
+        1000 * percentile(latencies, 50),
+        1000 * percentile(latencies, 95),
+        1000 * percentile(latencies, 99)))
+
+
+def run(update_baselines=False):
+    with open(PAYLOAD_FILE) as f:
+        payload = json.load(f)
+
+    path = reverse('shopify_order_create')
+    client = Client()
+
+    server = make_server('127.0.0.1', 0, WSGIHandler(),
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    stages = [
+        ('client/queued', True,
+         lambda body, headers: post_client(client, path, body, headers)),
+        ('client/eager', False,
+         lambda body, headers: post_client(client, path, body, headers)),
+        ('wsgi/eager', False,
+         lambda body, headers: post_http(server.server_address,
+                                         path, body, headers)),
+    ]
+
+    conf = dict(settings.WEBHOOK_SETTINGS['edx_shopify'], send_email=False)
+    course_cache.clear()
+    try:
+        with override_settings(ALLOWED_HOSTS=['*'],
+                               CELERY_ALWAYS_EAGER=True,
+                               WEBHOOK_SETTINGS={'edx_shopify': conf}), \
+                patch.multiple(utils,
+                               get_course_by_id=Mock(),
+                               enroll_email=Mock()):
+            print('%-14s %6s %10s %10s %10s %10s' % (
+                'stage', 'seats', 'req/s', 'p50 (ms)', 'p95 (ms)',
+                'p99 (ms)'))
+            for stage, queued, post in stages:
+                for seats in SEATS:
+                    if queued:
+                        with patch.object(tasks.process, 'delay'):
+                            latencies, rate = measure(post, payload, seats)
+                    else:
+                        latencies, rate = measure(post, payload, seats)
+                    report(stage, seats, latencies, rate)
+    finally:
+        course_cache.clear()
+        server.shutdown()
+        server.server_close()
+
+    return 0
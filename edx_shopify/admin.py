@@ -1,5 +1,130 @@
-from django.contrib import admin
+from datetime import timedelta
+from itertools import groupby, islice
 
-from .models import Order
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.functional import cached_property
 
-admin.site.register(Order)
+from .conf import get_setting
+from .models import Order, OrderItem
+from .tasks import requeue_orders
+from .utils import get_stuck_orders
+
+# Number of orders to reset, and queue over a single broker
+# connection, at a time when requeueing
+REQUEUE_CHUNK_SIZE = 500
+
+
+class CappedCountPaginator(Paginator):
+    """A paginator that counts no more than max_count objects.
+
+    Counting every row of a large table takes a full scan on some
+    databases, on every page of a changelist. Counting a limited
+    subquery stops at max_count rows instead, at the price of only
+    paging through that many.
+    """
+
+    max_count = 10000
+
+    @cached_property
+    def count(self):
+        return self.object_list[:self.max_count].count()
+
+
+def search_by_id_or_email(queryset, search_term, id_field):
+    """Narrow down a queryset by an exact order ID (if the search term
+    is a number) or email address, so that searches only ever use an
+    index rather than scanning the table like the default substring
+    search would.
+    """
+
+    search_term = search_term.strip()
+    if not search_term:
+        return queryset
+    if search_term.isdigit():
+        return queryset.filter(**{id_field: int(search_term)})
+    return queryset.filter(email=search_term)
+
+
+class OrderItemInline(admin.TabularInline):
+    model = OrderItem
+    fields = ('sku', 'email', 'status')
+    readonly_fields = ('sku', 'email')
+    extra = 0
+    can_delete = False
+
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ('id', 'email', 'first_name', 'last_name', 'received',
+                    'status')
+    list_filter = ('status', 'received')
+    search_fields = ('id', 'email')
+    ordering = ('-received',)
+    exclude = ('payload',)
+    readonly_fields = ('id', 'received')
+    inlines = [OrderItemInline]
+    actions = ['requeue_selected_orders']
+
+    # Don't count all orders on every page of a changelist
+    paginator = CappedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        return search_by_id_or_email(queryset, search_term, 'id'), False
+
+    def requeue_selected_orders(self, request, queryset):
+        """Reset the selected orders that failed, or are not processed
+        yet, and queue them for processing again.
+
+        PROCESSING orders are only requeued once they count as stuck
+        (see utils.get_stuck_orders()), after the stuck_after setting,
+        like reprocess_orders does by default: before that, they may
+        still be in the hands of a worker.
+        """
+
+        stuck_before = timezone.now() - timedelta(
+            minutes=get_setting('stuck_after', 60))
+        requeueable = Q(status__in=[Order.UNPROCESSED, Order.ERROR])
+        stuck = get_stuck_orders(stuck_before)
+        orders = queryset.filter(
+            requeueable | stuck
+        ).order_by('status').values_list('id', 'status').iterator()
+        send_email = get_setting('send_email', True)
+
+        requeued = skipped = 0
+        while True:
+            chunk = list(islice(orders, REQUEUE_CHUNK_SIZE))
+            if not chunk:
+                break
+            # Reset each status's orders with a few queries, and queue
+            # them over a single connection to the broker
+            for status, group in groupby(chunk, lambda order: order[1]):
+                order_ids = [order[0] for order in group]
+                count = len(requeue_orders(order_ids, status, send_email))
+                requeued += count
+                skipped += len(order_ids) - count
+
+        self.message_user(request,
+                          'Requeued %d order(s), skipped %d whose state '
+                          'changed. Processed orders, and orders that are '
+                          'still processing, are never requeued.' % (
+                              requeued, skipped),
+                          messages.SUCCESS)
+    requeue_selected_orders.short_description = 'Requeue selected orders'
+
+
+@admin.register(OrderItem)
+class OrderItemAdmin(admin.ModelAdmin):
+    list_display = ('order', 'sku', 'email', 'status')
+    list_filter = ('status',)
+    search_fields = ('order__id', 'email')
+    raw_id_fields = ('order',)
+    paginator = CappedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        return (search_by_id_or_email(queryset, search_term, 'order_id'),
+                False)
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class EdxShopifyConfig(AppConfig):
+    name = 'edx_shopify'
+    verbose_name = 'edX Shopify'
+
+    def ready(self):
+        # Connect signal receivers
+        from . import signals  # noqa: F401
@@ -0,0 +1,109 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from . import metrics
+from .conf import get_setting
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded LRU cache with per-entry expiry.
+
+    Values are produced by a loader callable on a cache miss. The
+    loader runs outside the lock, so a slow load does not block other
+    lookups; two concurrent misses on the same key may both load it.
+
+    If a name is given, hits and misses are also counted in the
+    cache.<name>.hit and cache.<name>.miss metrics.
+    """
+
+    def __init__(self, maxsize=128, ttl=300, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader=None):
+        """Return the cached value for key, calling loader(key) to
+        populate the cache if the key is missing or expired. Without a
+        loader, return None instead.
+        """
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > now:
+                # Re-insert to mark the entry as most recently used
+                self._entries[key] = entry
+                self.hits += 1
+                hit = True
+            else:
+                self.misses += 1
+                hit = False
+
+        if self.name:
+            metrics.incr('cache.%s.%s' % (self.name, 'hit' if hit else 'miss'))
+        if hit:
+            return entry[1]
+        if loader is None:
+            return None
+
+        value = loader(key)
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        "Store a value for key, evicting the least recently used if full."
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        "Drop a single key from the cache, if present."
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        "Drop all keys for which predicate(key) is true."
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        "Drop all entries and reset the hit/miss counters."
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        "Return a dictionary of hit/miss counters and the cache size."
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+
+# Per-worker cache of course descriptors, keyed by CourseKey
+course_cache = LRUCache(maxsize=get_setting('course_cache_size', 128),
+                        ttl=get_setting('course_cache_ttl', 300),
+                        name='course')
+
+# Per-worker cache of enrollment email parameters, keyed by
+# (CourseKey, site name)
+email_params_cache = LRUCache(
+    maxsize=get_setting('email_params_cache_size', 128),
+    ttl=get_setting('email_params_cache_ttl', 300),
+    name='email_params'
+)
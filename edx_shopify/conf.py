@@ -0,0 +1,12 @@
+from django.conf import settings
+
+
+def get_setting(name, default=None):
+    """Fetch an optional edx_shopify setting from WEBHOOK_SETTINGS,
+    falling back to a default if it is not configured.
+    """
+
+    try:
+        return settings.WEBHOOK_SETTINGS['edx_shopify'][name]
+    except KeyError:
+        return default
@@ -0,0 +1,52 @@
+from django.db.models import Count
+
+from .models import OrderItem
+
+
+def select_duplicates(rows):
+    """Given a list of (id, status) tuples for OrderItems sharing the
+    same order, SKU and email, return the ids of the rows to delete.
+
+    The row to keep is the first processed one, if any, and otherwise
+    the oldest one.
+    """
+
+    keep = next((pk for pk, status in rows
+                 if status == OrderItem.PROCESSED),
+                min(pk for pk, status in rows))
+    return [pk for pk, status in rows if pk != keep]
+
+
+def deduplicate_order_items(model=OrderItem, dry_run=False):
+    """Remove duplicate OrderItems, so that a unique constraint on
+    (order, sku, email) can be applied.
+
+    model may be a historical model when called from a migration.
+    Duplicate groups are streamed from the database, and each group
+    is deleted with a single query. With dry_run, nothing is deleted.
+
+    Return the number of rows deleted (or to be deleted).
+    """
+
+    groups = model.objects.values(
+        'order_id', 'sku', 'email'
+    ).annotate(
+        count=Count('id')
+    ).filter(
+        count__gt=1
+    ).order_by()
+
+    deleted = 0
+    for group in groups.iterator():
+        rows = list(model.objects.filter(
+            order_id=group['order_id'],
+            sku=group['sku'],
+            email=group['email']
+        ).values_list('id', 'status'))
+
+        duplicates = select_duplicates(rows)
+        if not dry_run:
+            model.objects.filter(id__in=duplicates).delete()
+        deleted += len(duplicates)
+
+    return deleted
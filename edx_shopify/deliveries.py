@@ -0,0 +1,53 @@
+"""Detection of webhook redeliveries.
+
+Shopify delivers webhooks at least once: it retries deliveries that
+time out, and sometimes sends duplicates under load. Every delivery
+of the same webhook carries the same X-Shopify-Webhook-Id, so once a
+delivery has been handled, further ones can be acknowledged without
+parsing or recording the order again.
+
+Delivered webhook IDs are remembered in a per-process LRU cache, in
+front of a Django cache shared by all LMS processes.
+"""
+from django.core.cache import caches
+
+from . import metrics
+from .cache import LRUCache
+from .conf import get_setting
+
+# Shopify keeps retrying a webhook for up to 48 hours
+DEFAULT_TTL = 48 * 60 * 60
+
+delivered_cache = LRUCache(maxsize=get_setting('webhook_id_cache_size', 4096),
+                           ttl=get_setting('webhook_id_ttl', DEFAULT_TTL),
+                           name='webhook_id')
+
+
+def get_shared_cache():
+    return caches[get_setting('webhook_id_cache', 'default')]
+
+
+def get_shared_key(webhook_id):
+    return 'edx_shopify:webhook:%s' % webhook_id
+
+
+def is_redelivery(webhook_id):
+    "Return True if the webhook with this ID was already handled."
+
+    if delivered_cache.get(webhook_id):
+        metrics.incr('webhook.duplicate.local')
+        return True
+
+    if get_shared_cache().get(get_shared_key(webhook_id)):
+        delivered_cache.set(webhook_id, True)
+        metrics.incr('webhook.duplicate.shared')
+        return True
+
+    return False
+
+
+def mark_delivered(webhook_id):
+    "Remember that the webhook with this ID has been handled."
+    delivered_cache.set(webhook_id, True)
+    get_shared_cache().set(get_shared_key(webhook_id), True,
+                           get_setting('webhook_id_ttl', DEFAULT_TTL))
@@ -0,0 +1,139 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.six.moves import queue
+
+from edx_shopify.api import get_session, iter_order_pages
+from edx_shopify.conf import get_setting
+from edx_shopify.messages import pack_order
+from edx_shopify.payload import load_created_at, load_order, PayloadError
+from edx_shopify.tasks import process
+from edx_shopify.utils import bulk_record_orders
+
+# Marks the end of the pages put on the queue by the fetcher thread
+DONE = object()
+
+
+class Command(BaseCommand):
+    help = ('Fetch orders from the Shopify Orders API, and record those '
+            'that are missing here (for example because a webhook was '
+            'never delivered).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status',
+                            choices=('open', 'closed', 'cancelled', 'any'),
+                            default='any',
+                            help='Only fetch orders in this state '
+                            '(default: any)')
+        parser.add_argument('--created-at-min',
+                            default=None,
+                            help='Only fetch orders created at or after '
+                            'this ISO 8601 date')
+        parser.add_argument('--include-cancelled',
+                            action='store_true',
+                            default=False,
+                            help='Also record (and with --process, '
+                            'process) cancelled orders, which are '
+                            'skipped by default')
+        parser.add_argument('--prefetch',
+                            type=int,
+                            default=4,
+                            help='Number of pages to fetch ahead of the '
+                            'database writes (default: 4)')
+        parser.add_argument('--process',
+                            action='store_true',
+                            default=False,
+                            help='Queue the missing orders for processing')
+        parser.add_argument('--no-email',
+                            action='store_true',
+                            default=False,
+                            help='Do not send enrollment emails when '
+                            'processing')
+
+    def handle(self, *args, **options):
+        self.process = options['process']
+        cancelled = options['status'] == 'cancelled'
+        self.include_cancelled = options['include_cancelled'] or cancelled
+        send_email = get_setting('send_email', True)
+        self.send_email = send_email and not options['no_email']
+
+        params = {'status': options['status']}
+        if options['created_at_min']:
+            params['created_at_min'] = options['created_at_min']
+
+        # Fetch pages in a separate thread, so that the next page is
+        # already on its way while the current one is written to the
+        # database. The bounded queue keeps the fetcher from running
+        # too far ahead.
+        pages = queue.Queue(maxsize=max(options['prefetch'], 1))
+        fetcher = threading.Thread(target=self.fetch_pages,
+                                   args=(params, pages))
+        fetcher.daemon = True
+        fetcher.start()
+
+        self.fetched = self.recorded = self.invalid = self.cancelled = 0
+        self.start = time.time()
+        while True:
+            page = pages.get()
+            if page is DONE:
+                break
+            if isinstance(page, Exception):
+                raise CommandError('Failed to fetch orders: %s' % page)
+            self.record_page(page)
+        fetcher.join()
+
+        self.stdout.write('Done: %s' % self.progress())
+
+    def fetch_pages(self, params, pages):
+        "Fetch all pages of orders, and put them on the queue."
+        session = get_session()
+        try:
+            for page in iter_order_pages(session, params):
+                pages.put(page)
+        except Exception as e:
+            pages.put(e)
+        else:
+            pages.put(DONE)
+        finally:
+            session.close()
+
+    def record_page(self, page):
+        "Record the orders on a page that are not stored yet."
+        records = []
+        received = {}
+        for payload in page:
+            self.fetched += 1
+            if payload.get('cancelled_at') and not self.include_cancelled:
+                self.cancelled += 1
+                continue
+            try:
+                data = load_order(payload)
+            except PayloadError as e:
+                self.invalid += 1
+                self.stderr.write('Order %s: %s' % (payload.get('id'), e))
+                continue
+
+            # Record the order as received when it was placed, not now
+            records.append(data)
+            received[data.id] = load_created_at(payload)
+
+        new = bulk_record_orders(records, received)
+        self.recorded += len(new)
+
+        for data in new:
+            self.stdout.write('Recorded missing order %d' % data.id)
+            if self.process:
+                process.delay(pack_order(data.id, data.line_items),
+                              self.send_email)
+
+    def progress(self):
+        "Describe the progress so far."
+        elapsed = max(time.time() - self.start, 0.001)
+        return ('fetched %d order(s), recorded %d missing, %d invalid, '
+                'skipped %d cancelled; %.0f orders/s' % (
+                    self.fetched,
+                    self.recorded,
+                    self.invalid,
+                    self.cancelled,
+                    self.fetched / elapsed))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from edx_shopify.dedupe import deduplicate_order_items
+
+
+class Command(BaseCommand):
+    help = ('Remove duplicate order items (same order, SKU and email), '
+            'keeping the processed one where there is one. Run this '
+            'ahead of migration 0002 on large tables.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            default=False,
+                            help='Only count duplicates, do not delete them')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        deleted = deduplicate_order_items(dry_run=dry_run)
+        if dry_run:
+            self.stdout.write('Found %d duplicate order item(s)' % deleted)
+        else:
+            self.stdout.write('Deleted %d duplicate order item(s)' % deleted)
@@ -0,0 +1,110 @@
+import resource
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from edx_shopify.conf import get_setting
+from edx_shopify.messages import pack_order
+from edx_shopify.payload import load_created_at, load_json, load_order
+from edx_shopify.payload import PayloadError
+from edx_shopify.tasks import process
+from edx_shopify.utils import bulk_record_orders
+
+
+class Command(BaseCommand):
+    help = ('Import Shopify orders from a file with one JSON order '
+            'payload per line (JSONL/NDJSON). Orders that already '
+            'exist are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path',
+                            help='File to import, or - for standard input')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=500,
+                            help='Number of orders to insert at a time '
+                            '(default: 500)')
+        parser.add_argument('--process',
+                            action='store_true',
+                            default=False,
+                            help='Queue imported orders for processing')
+        parser.add_argument('--no-email',
+                            action='store_true',
+                            default=False,
+                            help='Do not send enrollment emails when '
+                            'processing')
+
+    def handle(self, *args, **options):
+        self.process = options['process']
+        send_email = get_setting('send_email', True)
+        self.send_email = send_email and not options['no_email']
+        batch_size = options['batch_size']
+
+        if options['path'] == '-':
+            self.import_file(sys.stdin, batch_size)
+        else:
+            with open(options['path']) as f:
+                self.import_file(f, batch_size)
+
+    def import_file(self, f, batch_size):
+        "Import orders from an open file, one batch at a time."
+        self.read = self.imported = self.invalid = 0
+        self.start = time.time()
+
+        batch = []
+        received = {}
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            self.read += 1
+            try:
+                payload = load_json(line)
+                data = load_order(payload)
+            except PayloadError as e:
+                self.invalid += 1
+                self.stderr.write('Line %d: %s' % (lineno, e))
+                continue
+
+            # Historical orders keep the time they were placed, rather
+            # than looking like they just came in
+            batch.append(data)
+            received[data.id] = load_created_at(payload)
+
+            if len(batch) >= batch_size:
+                self.import_batch(batch, received)
+                batch = []
+                received = {}
+
+        if batch:
+            self.import_batch(batch, received)
+
+        self.stdout.write('Done: %s' % self.progress())
+
+    def import_batch(self, batch, received):
+        """Store a batch of orders, received at the given times (see
+        bulk_record_orders()), and queue them if requested.
+        """
+        new = bulk_record_orders(batch, received)
+        self.imported += len(new)
+
+        if self.process:
+            for data in new:
+                process.delay(pack_order(data.id, data.line_items),
+                              self.send_email)
+
+        self.stdout.write(self.progress())
+
+    def progress(self):
+        "Describe the progress so far, with throughput and peak memory."
+        elapsed = max(time.time() - self.start, 0.001)
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        return ('read %d record(s), imported %d, skipped %d existing, '
+                '%d invalid; %.0f records/s, peak RSS %.1f MiB' % (
+                    self.read,
+                    self.imported,
+                    self.read - self.imported - self.invalid,
+                    self.invalid,
+                    self.read / elapsed,
+                    peak_rss))
@@ -0,0 +1,203 @@
+import operator
+import threading
+import time
+
+from datetime import timedelta
+from functools import reduce
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from kombu.utils.limits import TokenBucket
+
+from edx_shopify.conf import get_setting
+from edx_shopify.models import Order
+from edx_shopify.tasks import requeue_order, requeue_orders
+from edx_shopify.utils import get_stuck_orders
+
+STATUSES = ('error', 'processing')
+
+
+class Command(BaseCommand):
+    help = ('Reprocess orders in the ERROR state, or stuck in the '
+            'PROCESSING state (for example after a worker crash).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status',
+                            nargs='+',
+                            choices=STATUSES,
+                            default=list(STATUSES),
+                            help='Order states to reprocess '
+                            '(default: all)')
+        parser.add_argument('--stuck-after',
+                            type=int,
+                            default=get_setting('stuck_after', 60),
+                            help='Only reprocess PROCESSING orders claimed '
+                            'for processing more than this many minutes '
+                            'ago (default: the stuck_after setting, or 60)')
+        parser.add_argument('--inline',
+                            action='store_true',
+                            default=False,
+                            help='Process orders in this process, rather '
+                            'than queueing tasks for the workers')
+        parser.add_argument('--workers',
+                            type=int,
+                            default=4,
+                            help='With --inline, number of orders to '
+                            'reprocess concurrently (default: 4)')
+        parser.add_argument('--rate',
+                            type=float,
+                            default=None,
+                            help='Reprocess at most this many orders '
+                            'per second (default: unlimited)')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=500,
+                            help='Number of orders to fetch from the '
+                            'database, and to reset and queue in one '
+                            'batch, at a time (default: 500)')
+        parser.add_argument('--no-email',
+                            action='store_true',
+                            default=False,
+                            help='Do not send enrollment emails')
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            default=False,
+                            help='Only list matching orders')
+
+    def handle(self, *args, **options):
+        self.inline = options['inline']
+        send_email = get_setting('send_email', True)
+        self.send_email = send_email and not options['no_email']
+        self.bucket = None
+        if options['rate']:
+            self.bucket = TokenBucket(fill_rate=options['rate'])
+        self.lock = threading.Lock()
+
+        orders = self.get_orders(options['status'], options['stuck_after'])
+
+        # Orders processed right here may be processed concurrently.
+        # Queued orders are reset and queued a chunk at a time instead.
+        concurrent = options['workers'] > 1 and not options['dry_run']
+        pool = None
+        if self.inline and concurrent:
+            pool = ThreadPool(options['workers'])
+
+        found = requeued = skipped = 0
+        start = time.time()
+        try:
+            for chunk in iter(lambda: list(islice(orders,
+                                                  options['chunk_size'])),
+                              []):
+                found += len(chunk)
+                if options['dry_run']:
+                    for order_id, status in chunk:
+                        self.stdout.write('Order %s (%s)' % (
+                            order_id,
+                            dict(Order.STATUS_CHOICES)[status]))
+                    continue
+
+                if not self.inline:
+                    results = self.requeue_chunk(chunk)
+                elif pool is None:
+                    results = [self.reprocess(order) for order in chunk]
+                else:
+                    results = pool.map(self.reprocess_in_thread, chunk)
+
+                requeued += results.count(True)
+                skipped += results.count(False)
+                elapsed = max(time.time() - start, 0.001)
+                self.stdout.write('Reprocessed %d of %d order(s), '
+                                  'skipped %d, %.1f orders/s' % (
+                                      requeued,
+                                      found,
+                                      skipped,
+                                      requeued / elapsed))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if options['dry_run']:
+            self.stdout.write('Found %d order(s) to reprocess' % found)
+        else:
+            self.stdout.write('Done: reprocessed %d order(s), skipped %d, '
+                              'in %.1fs' % (requeued,
+                                            skipped,
+                                            time.time() - start))
+
+    def get_orders(self, statuses, stuck_after):
+        """Stream the (id, status) tuples of the orders to reprocess, oldest
+        first.
+        """
+
+        queries = []
+        if 'error' in statuses:
+            queries.append(Q(status=Order.ERROR))
+        if 'processing' in statuses:
+            stuck_before = timezone.now() - timedelta(minutes=stuck_after)
+            queries.append(get_stuck_orders(stuck_before))
+
+        return Order.objects.filter(reduce(operator.or_, queries)).order_by(
+            'received'
+        ).values_list('id', 'status').iterator()
+
+    def reprocess(self, order):
+        "Reprocess an order, given its (id, status) tuple."
+        order_id, status = order
+        self.throttle()
+        requeued = requeue_order(order_id, status,
+                                 send_email=self.send_email,
+                                 inline=self.inline)
+        if not requeued:
+            self.skip(order_id)
+        return requeued
+
+    def requeue_chunk(self, chunk):
+        """Reset and queue a chunk of orders, given their (id, status)
+        tuples, in one batch per status (see tasks.requeue_orders()).
+        Return whether each order was requeued.
+        """
+
+        by_status = {}
+        for order_id, status in chunk:
+            self.throttle()
+            by_status.setdefault(status, []).append(order_id)
+
+        requeued = set()
+        for status, order_ids in by_status.items():
+            requeued.update(requeue_orders(order_ids, status,
+                                           send_email=self.send_email))
+
+        results = []
+        for order_id, status in chunk:
+            if order_id not in requeued:
+                self.skip(order_id)
+            results.append(order_id in requeued)
+        return results
+
+    def skip(self, order_id):
+        "Report an order that could not be reprocessed."
+        self.stderr.write('Skipped order %s: its state changed, or '
+                          'it has no line items' % order_id)
+
+    def reprocess_in_thread(self, order):
+        """Reprocess an order from a pool thread, closing the thread's
+        database connection when done.
+        """
+
+        try:
+            return self.reprocess(order)
+        finally:
+            connection.close()
+
+    def throttle(self):
+        "Wait until the rate limit allows reprocessing another order."
+        if self.bucket is None:
+            return
+        with self.lock:
+            while not self.bucket.can_consume(1):
+                time.sleep(self.bucket.expected_time(1))
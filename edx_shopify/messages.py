@@ -0,0 +1,65 @@
+"""Compact order processing task messages.
+
+Rather than the full Shopify order payload, the order processing task
+receives the order ID and a list of (sku, email) pairs. Large item
+lists are zlib-compressed. A message may also carry just the order ID,
+in which case the task uses the payload stored with the order.
+"""
+import base64
+import json
+import numbers
+import zlib
+
+from .payload import LineItem, extract_line_items
+
+# Compress item lists whose JSON encoding exceeds this many bytes
+COMPRESS_THRESHOLD = 1024
+
+
+def pack_order(order_id, line_items=None):
+    """Build a task message from an order ID and a list of (sku, email)
+    pairs, such as the line_items of an OrderData record.
+
+    Without line items, build a message to process the order from its
+    stored payload.
+    """
+
+    if line_items is None:
+        return {'id': order_id}
+
+    items = [list(item) for item in line_items]
+    encoded = json.dumps(items, separators=(',', ':'))
+    if len(encoded) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(encoded.encode('utf-8'))
+        return {
+            'id': order_id,
+            'zitems': base64.b64encode(compressed).decode('ascii'),
+        }
+    return {
+        'id': order_id,
+        'items': items,
+    }
+
+
+def unpack_order(message):
+    """Return the order ID and the list of (sku, email) pairs from a task
+    message. The list is None if the message only carries the order
+    ID (which may also be passed as a plain integer).
+
+    Also accept the full Shopify order payload, as queued by earlier
+    versions of this app.
+    """
+
+    if isinstance(message, numbers.Integral):
+        return message, None
+    elif 'line_items' in message:
+        items = extract_line_items(message['line_items'])
+    elif 'zitems' in message:
+        compressed = base64.b64decode(message['zitems'])
+        items = json.loads(zlib.decompress(compressed).decode('utf-8'))
+    elif 'items' in message:
+        items = message['items']
+    else:
+        return message['id'], None
+
+    return message['id'], [LineItem(*item) for item in items]
@@ -0,0 +1,274 @@
+"""Timers and counters for the stages of order processing.
+
+Metrics go to a pluggable backend, configured with the metrics_backend
+setting (the dotted path of a backend class) and metrics_options (a
+dictionary of keyword arguments for it). The default backend discards
+everything, and costs next to nothing.
+"""
+import logging
+import socket
+import threading
+import time
+
+from collections import defaultdict
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the histogram buckets for timings
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Timer(object):
+    """A context manager that reports the time spent in its block to
+    a metrics backend, whether or not the block raises.
+    """
+
+    __slots__ = ('backend', 'name', 'start')
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.backend.timing(self.name, time.time() - self.start)
+
+
+class NullTimer(object):
+    "A context manager that does nothing."
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class BaseMetrics(object):
+    "Base class for metrics backends."
+
+    def incr(self, name, value=1):
+        "Increment a counter."
+        raise NotImplementedError
+
+    def timing(self, name, seconds):
+        "Record a duration, in seconds."
+        raise NotImplementedError
+
+    def timer(self, name):
+        "Return a context manager that times its block."
+        return Timer(self, name)
+
+    def get_counter(self, name):
+        """Return the value of a counter, or None if the backend does
+        not keep counters.
+        """
+        return None
+
+    def get_histogram(self, name):
+        """Return the histogram of the durations recorded for name, as
+        a (buckets, sum, count) tuple, where buckets is a list of
+        (upper bound, cumulative count) pairs ending with infinity.
+
+        Return None if the backend does not keep histograms.
+        """
+        return None
+
+
+def bucket_index(seconds, buckets=BUCKETS):
+    "Return the index of the histogram bucket a duration falls into."
+    for index, bound in enumerate(buckets):
+        if seconds <= bound:
+            return index
+    return len(buckets)
+
+
+def make_histogram(counts, total, buckets=BUCKETS):
+    """Return a histogram, as returned by get_histogram(), given the
+    (non-cumulative) counts for each bucket and the sum of durations.
+    """
+    cumulative = 0
+    pairs = []
+    for bound, count in zip(tuple(buckets) + (float('inf'),), counts):
+        cumulative += count
+        pairs.append((bound, cumulative))
+    return pairs, total, cumulative
+
+
+class NullMetrics(BaseMetrics):
+    "Discard all metrics. This is the default backend."
+
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def timer(self, name):
+        return NULL_TIMER
+
+
+class LoggingMetrics(BaseMetrics):
+    "Log every metric, at the given level."
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def incr(self, name, value=1):
+        logger.log(self.level, 'metric %s +%d', name, value)
+
+    def timing(self, name, seconds):
+        logger.log(self.level, 'metric %s %.1fms', name, seconds * 1000)
+
+
+class MemoryMetrics(BaseMetrics):
+    """Keep all metrics in memory, in the counters and timings
+    dictionaries. Useful in tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def reset(self):
+        "Forget all metrics recorded so far."
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.timings = defaultdict(list)
+
+    def get_counter(self, name):
+        with self._lock:
+            return self.counters.get(name, 0)
+
+    def get_histogram(self, name):
+        with self._lock:
+            timings = list(self.timings.get(name, []))
+        counts = [0] * (len(BUCKETS) + 1)
+        for seconds in timings:
+            counts[bucket_index(seconds)] += 1
+        return make_histogram(counts, sum(timings))
+
+
+class CacheMetrics(BaseMetrics):
+    """Keep counters and timing histograms in a Django cache, so that
+    they add up across all web and worker processes sharing it.
+
+    The cache backend must increment atomically (like memcached or
+    Redis do) for the counts to be exact.
+    """
+
+    def __init__(self, cache='default', prefix='edx_shopify:metrics'):
+        self.cache = caches[cache]
+        self.prefix = prefix
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def _incr(self, key, delta):
+        self.cache.add(key, 0, timeout=None)
+        try:
+            self.cache.incr(key, delta)
+        except ValueError:
+            # The key was evicted in the meantime
+            self.cache.add(key, delta, timeout=None)
+
+    def incr(self, name, value=1):
+        self._incr(self._key('counter', name), value)
+
+    def timing(self, name, seconds):
+        self._incr(self._key('timing', name, str(bucket_index(seconds))), 1)
+        # Durations add up in whole microseconds, as the cache can
+        # only increment integers
+        self._incr(self._key('timing', name, 'sum'),
+                   int(round(seconds * 1000000)))
+
+    def get_counter(self, name):
+        return self.cache.get(self._key('counter', name), 0)
+
+    def get_histogram(self, name):
+        keys = [self._key('timing', name, str(index))
+                for index in range(len(BUCKETS) + 1)]
+        sum_key = self._key('timing', name, 'sum')
+        values = self.cache.get_many(keys + [sum_key])
+        counts = [values.get(key, 0) for key in keys]
+        return make_histogram(counts, values.get(sum_key, 0) / 1000000.0)
+
+
+class StatsdMetrics(BaseMetrics):
+    """Send metrics to a statsd server over UDP. Sending never blocks,
+    and errors are ignored.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='edx_shopify'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def send(self, stat):
+        try:
+            self.socket.sendto(stat.encode('ascii'), self.address)
+        except socket.error:
+            pass
+
+    def incr(self, name, value=1):
+        self.send('%s.%s:%d|c' % (self.prefix, name, value))
+
+    def timing(self, name, seconds):
+        self.send('%s.%s:%.3f|ms' % (self.prefix, name, seconds * 1000))
+
+
+_backend = None
+
+
+def get_backend():
+    "Return the configured metrics backend, creating it on first use."
+    global _backend
+    if _backend is None:
+        backend_class = import_string(
+            get_setting('metrics_backend', 'edx_shopify.metrics.NullMetrics')
+        )
+        _backend = backend_class(**get_setting('metrics_options', {}))
+    return _backend
+
+
+def reset_backend():
+    "Drop the metrics backend, so that it is created anew on next use."
+    global _backend
+    _backend = None
+
+
+def incr(name, value=1):
+    "Increment a counter."
+    get_backend().incr(name, value)
+
+
+def timing(name, seconds):
+    "Record a duration, in seconds."
+    get_backend().timing(name, seconds)
+
+
+def timer(name):
+    "Return a context manager that times its block."
+    return get_backend().timer(name)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.utils.timezone
+
+# OrderItem.PROCESSED as of this migration
+ORDER_ITEM_PROCESSED = 1
+
+
+def remove_duplicate_order_items(apps, schema_editor):
+    # Duplicates would make adding the unique constraint fail. On
+    # large tables, run the dedupe_order_items management command
+    # ahead of the migration, so this step has nothing left to do.
+    #
+    # This is a frozen copy of edx_shopify.dedupe, so that later
+    # changes to the app don't change what the migration does.
+    OrderItem = apps.get_model('edx_shopify', 'OrderItem')
+
+    groups = OrderItem.objects.values(
+        'order_id', 'sku', 'email'
+    ).annotate(
+        count=Count('id')
+    ).filter(
+        count__gt=1
+    ).order_by()
+
+    for group in groups.iterator():
+        rows = list(OrderItem.objects.filter(
+            order_id=group['order_id'],
+            sku=group['sku'],
+            email=group['email']
+        ).values_list('id', 'status'))
+
+        # Keep the first processed row, if any, and otherwise the
+        # oldest one
+        keep = next((pk for pk, status in rows
+                     if status == ORDER_ITEM_PROCESSED),
+                    min(pk for pk, status in rows))
+        OrderItem.objects.filter(
+            id__in=[pk for pk, status in rows if pk != keep]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edx_shopify', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_order_items,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='received',
+            field=models.DateTimeField(default=django.utils.timezone.now, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='email',
+            field=models.EmailField(max_length=254, db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='orderitem',
+            unique_together=set([('order', 'sku', 'email')]),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'received'], name='edx_shopify_order_status_idx'),
+        ),
+    ]
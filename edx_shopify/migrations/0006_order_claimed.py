@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edx_shopify', '0005_order_claimed_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='claimed',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edx_shopify', '0006_order_claimed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orderitem',
+            name='status',
+            field=models.IntegerField(db_index=True, default=0, choices=[(0, b'Unprocessed'), (1, b'Processed'), (2, b'Error')]),
+        ),
+    ]
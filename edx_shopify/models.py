@@ -1,5 +1,8 @@
 from django.db import models
 from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .payload import decode_order
 
 APP_LABEL = 'edx_shopify'
 
@@ -7,6 +10,12 @@ APP_LABEL = 'edx_shopify'
 class Order(models.Model):
     class Meta:
         app_label = APP_LABEL
+        indexes = [
+            # Serves lookups by status, optionally narrowed down or
+            # sorted by the date received
+            models.Index(fields=['status', 'received'],
+                         name='edx_shopify_order_status_idx'),
+        ]
 
     UNPROCESSED = 0
     PROCESSING = 1
@@ -21,16 +30,35 @@ class Order(models.Model):
     )
 
     id = models.BigIntegerField(primary_key=True, editable=False)
-    email = models.EmailField()
+    email = models.EmailField(db_index=True)
     first_name = models.CharField(max_length=254)
     last_name = models.CharField(max_length=254)
-    received = models.DateTimeField(default=timezone.now)
+    received = models.DateTimeField(default=timezone.now, db_index=True)
     status = models.IntegerField(choices=STATUS_CHOICES, default=UNPROCESSED)
+    # Who claimed the order for processing (see utils.start_order()),
+    # such as the ID of the task processing it
+    claimed_by = models.CharField(max_length=255, null=True, editable=False)
+    # When the order was last claimed for processing
+    claimed = models.DateTimeField(null=True, editable=False)
+    # The OrderData record of the order, compressed (see
+    # payload.encode_order()), so the order can be replayed locally
+    payload = models.BinaryField(null=True)
+
+    @cached_property
+    def data(self):
+        """The stored OrderData record of the order, decoded on first
+        access, or None for orders stored without one.
+        """
+
+        if self.payload is None:
+            return None
+        return decode_order(self.payload)
 
 
 class OrderItem(models.Model):
     class Meta:
         app_label = APP_LABEL
+        unique_together = ('order', 'sku', 'email')
 
     UNPROCESSED = 0
     PROCESSED = 1
@@ -44,7 +72,6 @@ class OrderItem(models.Model):
 
     order = models.ForeignKey(Order)
     sku = models.CharField(max_length=254)
-    email = models.EmailField()
-    status = models.IntegerField(choices=STATUS_CHOICES, default=UNPROCESSED)
-
-    unique_together = ('order', 'sku', 'email')
+    email = models.EmailField(db_index=True)
+    status = models.IntegerField(choices=STATUS_CHOICES, default=UNPROCESSED,
+                                 db_index=True)
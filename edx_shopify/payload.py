@@ -0,0 +1,116 @@
+"""Extraction of order data from Shopify order payloads.
+
+The webhook view parses each payload exactly once into an OrderData
+record holding only the fields this app uses, and validates it on the
+way. Everything downstream works on that record, not on the payload.
+"""
+import json
+import zlib
+
+from collections import namedtuple
+
+from django.utils.dateparse import parse_datetime
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+OrderData = namedtuple('OrderData', ['id',
+                                     'email',
+                                     'first_name',
+                                     'last_name',
+                                     'line_items'])
+
+LineItem = namedtuple('LineItem', ['sku', 'email'])
+
+
+class PayloadError(ValueError):
+    "An order payload is malformed or lacks required fields."
+
+
+def parse_order(body):
+    "Parse a raw (JSON) order payload into an OrderData record."
+    return load_order(load_json(body))
+
+
+def load_json(body):
+    "Decode a raw (JSON) order payload."
+    try:
+        return json.loads(body)
+    except ValueError as e:
+        raise PayloadError('Invalid JSON: %s' % e)
+
+
+def load_order(data):
+    "Extract an OrderData record from a decoded order payload."
+    try:
+        customer = data['customer']
+        return OrderData(
+            id=int(data['id']),
+            email=get_string(customer, 'email'),
+            first_name=customer.get('first_name') or '',
+            last_name=customer.get('last_name') or '',
+            line_items=extract_line_items(data['line_items'])
+        )
+    except (KeyError, TypeError, AttributeError) as e:
+        raise PayloadError('Missing or invalid field: %s' % e)
+    except ValueError as e:
+        raise PayloadError('Invalid order ID: %s' % e)
+
+
+def load_created_at(data):
+    """Return when an order was created in Shopify, from the created_at
+    field of a decoded order payload, or None if it has none (or not a
+    valid one).
+    """
+
+    try:
+        return parse_datetime(data.get('created_at') or '')
+    except (TypeError, ValueError):
+        return None
+
+
+def encode_order(data):
+    """Encode an OrderData record for storage, as zlib-compressed
+    JSON.
+    """
+
+    encoded = json.dumps(list(data), separators=(',', ':'))
+    return zlib.compress(encoded.encode('utf-8'))
+
+
+def decode_order(encoded):
+    "Decode an OrderData record encoded with encode_order()."
+    (order_id, email, first_name, last_name, line_items) = json.loads(
+        zlib.decompress(bytes(encoded)).decode('utf-8'))
+    return OrderData(id=order_id,
+                     email=email,
+                     first_name=first_name,
+                     last_name=last_name,
+                     line_items=[LineItem(*item) for item in line_items])
+
+
+def extract_line_items(line_items):
+    "Extract LineItem records from the line items of an order payload."
+    return [LineItem(get_string(item, 'sku'), get_line_item_email(item))
+            for item in line_items]
+
+
+def get_line_item_email(item):
+    """Extract the email address from a line item's properties.
+
+    Raise KeyError if the line item has no email property.
+    """
+    for p in item['properties']:
+        if p['name'] == 'email':
+            return get_string(p, 'value')
+    raise KeyError('email')
+
+
+def get_string(data, key):
+    "Fetch a string value from a dictionary, or raise TypeError."
+    value = data[key]
+    if not isinstance(value, string_types):
+        raise TypeError('%s must be a string' % key)
+    return value
@@ -0,0 +1,144 @@
+"""Order pipeline health, in the Prometheus text exposition format.
+
+Everything here must stay cheap enough to scrape every few seconds,
+however many orders there are: orders in a non-final state, and those
+in the ERROR state, are counted and aged through the (status,
+received) index, and only the (ever growing) count of processed
+orders is cached between scrapes. PROCESSING orders are aged by when
+they were claimed, from the few rows in that status.
+"""
+from django.core.cache import cache
+from django.db.models import Min
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import metrics
+from .conf import get_setting
+from .models import Order
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STATUS_NAMES = {
+    Order.UNPROCESSED: 'unprocessed',
+    Order.PROCESSING: 'processing',
+    Order.PROCESSED: 'processed',
+    Order.ERROR: 'error',
+}
+
+# Timings exposed as latency histograms
+HISTOGRAMS = (
+    ('webhook', 'Time to handle an order creation webhook'),
+    ('order.process', 'Time to process an order'),
+)
+
+# Counters exposed as such
+COUNTERS = (
+    ('webhook.duplicate.local', 'Webhook redeliveries detected in the '
+     'per-process cache'),
+    ('webhook.duplicate.shared', 'Webhook redeliveries detected in the '
+     'shared cache'),
+)
+
+PROCESSED_COUNT_KEY = 'edx_shopify:processed_count'
+
+
+def get_order_counts():
+    "Return a dictionary mapping order statuses to order counts."
+
+    counts = {}
+    for status in (Order.UNPROCESSED, Order.PROCESSING, Order.ERROR):
+        counts[status] = Order.objects.filter(status=status).count()
+
+    processed = cache.get(PROCESSED_COUNT_KEY)
+    if processed is None:
+        processed = Order.objects.filter(status=Order.PROCESSED).count()
+        cache.set(PROCESSED_COUNT_KEY, processed,
+                  get_setting('processed_count_ttl', 300))
+    counts[Order.PROCESSED] = processed
+
+    return counts
+
+
+def get_oldest_order_ages():
+    """Return a dictionary mapping the non-final order statuses to the
+    age, in seconds, of the oldest order in that status (or 0 if there
+    is none).
+
+    UNPROCESSED orders are aged by when they were received. PROCESSING
+    orders are aged by when they were claimed, like get_stuck_orders()
+    does, so that an old order reprocessed right now does not look
+    stuck; orders claimed before claims were timestamped go by when
+    they were received.
+    """
+
+    now = timezone.now()
+    received = Order.objects.filter(
+        status=Order.UNPROCESSED
+    ).order_by('received').values_list('received', flat=True).first()
+    claimed = Order.objects.filter(
+        status=Order.PROCESSING
+    ).aggregate(oldest=Min(Coalesce('claimed', 'received')))['oldest']
+
+    ages = {}
+    for status, since in ((Order.UNPROCESSED, received),
+                          (Order.PROCESSING, claimed)):
+        ages[status] = (now - since).total_seconds() if since else 0
+    return ages
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render_metrics():
+    "Return the current metrics, as Prometheus text."
+
+    lines = [
+        '# HELP edx_shopify_orders Number of orders, by status.',
+        '# TYPE edx_shopify_orders gauge',
+    ]
+    for status, count in sorted(get_order_counts().items()):
+        lines.append('edx_shopify_orders{status="%s"} %d' % (
+            STATUS_NAMES[status], count))
+
+    lines += [
+        '# HELP edx_shopify_oldest_order_age_seconds Age of the oldest '
+        'order waiting to be processed, by status: since it was received, '
+        'or claimed if processing.',
+        '# TYPE edx_shopify_oldest_order_age_seconds gauge',
+    ]
+    for status, age in sorted(get_oldest_order_ages().items()):
+        lines.append('edx_shopify_oldest_order_age_seconds{status="%s"} %s'
+                     % (STATUS_NAMES[status], format_value(age)))
+
+    backend = metrics.get_backend()
+    for name, description in COUNTERS:
+        value = backend.get_counter(name)
+        if value is None:
+            continue
+        metric = 'edx_shopify_%s_total' % name.replace('.', '_')
+        lines += [
+            '# HELP %s %s.' % (metric, description),
+            '# TYPE %s counter' % metric,
+            '%s %d' % (metric, value),
+        ]
+
+    for name, description in HISTOGRAMS:
+        histogram = backend.get_histogram(name)
+        if histogram is None:
+            continue
+        buckets, total, count = histogram
+        metric = 'edx_shopify_%s_seconds' % name.replace('.', '_')
+        lines += [
+            '# HELP %s %s.' % (metric, description),
+            '# TYPE %s histogram' % metric,
+        ]
+        for bound, cumulative in buckets:
+            lines.append('%s_bucket{le="%s"} %d' % (
+                metric, format_value(bound), cumulative))
+        lines.append('%s_sum %s' % (metric, format_value(total)))
+        lines.append('%s_count %d' % (metric, count))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,64 @@
+"""Rate limiting of enrollment notification emails across workers.
+
+A limit enforced by each worker process on its own would let N
+processes (or threads, or greenlets) send N times the intended rate.
+Instead, emails are counted in a Django cache shared by all workers,
+such as memcached, whose increments are atomic.
+"""
+import math
+import time
+
+from django.core.cache import caches
+
+
+class RateLimiter(object):
+    """A fixed-window rate limiter, counted in a Django cache.
+
+    Time is cut into windows of capacity / rate seconds, in each of
+    which at most capacity tokens may be consumed. This averages out
+    to rate tokens per second, with bursts of up to capacity tokens.
+
+    The interface is that of kombu.utils.limits.TokenBucket, as far
+    as send_enrollment_emails() and notify_enrollments use it.
+    """
+
+    def __init__(self, rate, capacity=None, cache='default',
+                 prefix='edx_shopify:email_rate'):
+        if rate <= 0:
+            raise ValueError('rate must be positive, not %r' % rate)
+        self.fill_rate = float(rate)
+        # A rate below one token per second still allows one token
+        # per window
+        self.capacity = max(int(capacity or rate), 1)
+        self.period = self.capacity / self.fill_rate
+        self.cache = caches[cache]
+        self.prefix = prefix
+
+    def _window(self, now):
+        return int(now // self.period)
+
+    def can_consume(self, tokens=1):
+        """Consume tokens from the current window, returning False if
+        the window has run out of them.
+        """
+
+        key = '%s:%d' % (self.prefix, self._window(time.time()))
+        timeout = int(math.ceil(self.period)) + 1
+        self.cache.add(key, 0, timeout=timeout)
+        try:
+            count = self.cache.incr(key, tokens)
+        except ValueError:
+            # The key expired or was evicted in the meantime
+            self.cache.add(key, tokens, timeout=timeout)
+            count = tokens
+        return count <= self.capacity
+
+    def expected_time(self, tokens=1):
+        """Return the time, in seconds, until the given number of tokens
+        can be consumed at the earliest.
+        """
+
+        now = time.time()
+        next_window = (self._window(now) + 1) * self.period
+        windows = int(math.ceil(float(tokens) / self.capacity)) - 1
+        return next_window - now + max(windows, 0) * self.period
@@ -0,0 +1,44 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from openedx.core.djangoapps.site_configuration.models import (
+    SiteConfiguration
+)
+from xmodule.modulestore.django import SignalHandler
+
+from . import metrics, verify
+from .cache import course_cache, email_params_cache
+
+
+@receiver(SignalHandler.course_published)
+@receiver(SignalHandler.course_deleted)
+def invalidate_course_cache(sender, course_key, **kwargs):
+    """Drop a course, and its email parameters, from the caches when it
+    is published or deleted.
+
+    These signals are only sent in the process that publishes or
+    deletes the course, usually Studio. In the LMS Celery workers,
+    cached courses only expire after course_cache_ttl.
+    """
+    course_cache.invalidate(course_key)
+    email_params_cache.invalidate_if(lambda key: key[0] == course_key)
+
+
+@receiver(post_save, sender=SiteConfiguration)
+def invalidate_email_params_cache(sender, **kwargs):
+    """Drop all cached email parameters when a site configuration
+    changes. Like invalidate_course_cache(), this only affects the
+    process that saves the configuration; other processes pick up the
+    change once their cached parameters expire.
+    """
+    email_params_cache.invalidate_if(lambda key: True)
+
+
+@receiver(setting_changed)
+def reset_from_settings(sender, setting, **kwargs):
+    """Pick up a new metrics backend and webhook keys when the settings
+    change (in tests).
+    """
+    if setting == 'WEBHOOK_SETTINGS':
+        metrics.reset_backend()
+        verify.reset_verifier()
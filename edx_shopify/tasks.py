@@ -1,30 +1,81 @@
+import numbers
+import random
+import socket
+
 from celery import Task
+from celery import chord
 from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.utils.log import get_task_logger
+from django.db import InterfaceError, OperationalError
+from pymongo.errors import ConnectionFailure
 
+from .conf import get_setting
+from .messages import pack_order, unpack_order
 from .models import Order
-from .utils import process_order
+from .ratelimit import RateLimiter
+from .utils import process_order, send_enrollment_emails
+from .utils import start_order, process_order_items, finish_order
+from .utils import record_order_items, group_line_items
+from .utils import chunk_line_items, fail_order_items
+from .utils import get_unprocessed_line_items, reset_order
+from .utils import reset_orders
 
 logger = get_task_logger(__name__)
 
+# Errors that are likely to go away by themselves, such as deadlocks
+# and lost connections (MySQL, MongoDB, SMTP), or a modulestore that is
+# too slow for the time limit. Anything else, such as Http404 for an
+# unknown SKU or ValidationError for an invalid email, is permanent.
+TRANSIENT_ERRORS = (
+    OperationalError,
+    InterfaceError,
+    ConnectionFailure,
+    SoftTimeLimitExceeded,
+    socket.error,
+)
+
+
+def get_email_bucket():
+    """Return the rate limiter for enrollment emails, shared by all
+    workers through the email_rate_cache, or None if email_rate is not
+    set.
+    """
+
+    rate = get_setting('email_rate')
+    if rate is None:
+        return None
+    return RateLimiter(rate,
+                       capacity=get_setting('email_burst', rate),
+                       cache=get_setting('email_rate_cache', 'default'))
+
 
 class OrderTask(Task):
     """Process a newly received order.
 
     On failure, store the order in an ERROR state.
+
+    A task instance is shared by all concurrent invocations in a
+    worker process (threads or greenlets alike), so handlers must not
+    rely on instance state. Instead, they look up the order from the
+    task arguments of the invocation at hand.
     """
 
-    def __init__(self):
-        """Set up an order as an instance member, so we can manipulate it both
-        from task methods and from handlers.
-        """
+    def get_order_id(self, args, kwargs):
+        """Return the ID of the order that an invocation processed.
 
-        self.order = None
+        The ID is read straight from the message, without unpacking
+        its line items, which may be what made the task fail.
+        """
+        data = args[0] if args else kwargs['data']
+        if isinstance(data, numbers.Integral):
+            return data
+        return data['id']
 
     def on_success(self, retval, task_id, args, kwargs):
         "Success handler: log successful order processing."
         logger.info('Successfully processed '
-                    'order %s' % self.order.id)
+                    'order %s' % self.get_order_id(args, kwargs))
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         """Failure handler: log an exception stack trace and a prose message,
@@ -32,13 +83,13 @@ class OrderTask(Task):
 
         """
 
+        order_id = self.get_order_id(args, kwargs)
         logger.error(exc, exc_info=True)
         logger.error('Failed to fully '
                      'process order %s '
-                     '(task ID %s)' % (self.order.id,
+                     '(task ID %s)' % (order_id,
                                        task_id))
-        self.order.status = Order.ERROR
-        self.order.save()
+        Order.objects.filter(id=order_id).update(status=Order.ERROR)
 
 
 @shared_task(bind=True,
@@ -48,11 +99,245 @@ class OrderTask(Task):
 def process(self, data, send_email=False):
     """Parse input data for line items, and create enrollments.
 
-    On any error, raise the exception in order to be handled by
-    on_failure().
+    The input data is a message built with messages.pack_order(), or
+    the full Shopify order payload for tasks queued by earlier
+    versions. If the message carries no line items, take them from
+    the payload stored with the order.
+
+    If chunk_size is configured and the order has more line items
+    than that, fan the line items out to process_chunk tasks, and let
+    finish_chunks set the order status once all chunks are done.
+
+    On a transient error (see TRANSIENT_ERRORS), retry with backoff,
+    re-attempting only the line items that have not been processed
+    yet. On any other error, or once retries are exhausted, raise the
+    exception in order to be handled by on_failure().
     """
 
     logger.debug('Processing order data: %s' % data)
-    self.order = Order.objects.get(id=data['id'])
+    order = line_items = None
+    try:
+        order_id, line_items = unpack_order(data)
+        order = Order.objects.get(id=order_id)
+        if line_items is None:
+            line_items = get_stored_line_items(order)
+
+        # The order is claimed under this task's ID, which stays the
+        # same across retries. A retry thus picks up an order that an
+        # earlier attempt left in the PROCESSING state, but not one
+        # that another task has claimed since.
+        claim = self.request.id
+        resume = self.request.retries > 0
+
+        chunk_size = get_setting('chunk_size')
+        if chunk_size and len(line_items) > chunk_size:
+            fan_out_order(order, line_items, chunk_size, send_email,
+                          resume, claim)
+        else:
+            process_order(order, line_items, send_email, logger,
+                          notify=queue_enrollment_emails,
+                          resume=resume,
+                          claim=claim)
+    except TRANSIENT_ERRORS as exc:
+        retry_line_items(self, order, line_items, send_email, exc)
+        raise
+
+
+def get_stored_line_items(order):
+    "Return the line items from the payload stored with an order."
+    if order.data is None:
+        raise ValueError('Order %s has no stored payload' % order.id)
+    return order.data.line_items
+
+
+def requeue_order(order_id, status, send_email=True, inline=False):
+    """Reset an order in the given status (see utils.reset_order()), and
+    process it again: queue a process task or, with inline, run it
+    right here.
+
+    Return False if the order could not be reset.
+    """
+
+    line_items = reset_order(order_id, status)
+    if line_items is None:
+        return False
+
+    message = pack_order(order_id, line_items)
+    if inline:
+        process.apply(args=(message, send_email))
+    else:
+        process.delay(message, send_email)
+    return True
+
+
+def requeue_orders(order_ids, status, send_email=True):
+    """Reset a batch of orders in the given status (see
+    utils.reset_orders()), and queue a process task for each of them,
+    publishing all tasks over a single broker connection.
+
+    Return the IDs of the orders requeued.
+    """
+
+    line_items = reset_orders(order_ids, status)
+    with process.app.producer_or_acquire() as producer:
+        for order_id, items in line_items.items():
+            process.apply_async((pack_order(order_id, items), send_email),
+                                producer=producer)
+    return list(line_items)
+
+
+def retry_line_items(task, order, line_items, send_email, exc):
+    """Retry a task for the line items of an order that have not been
+    processed yet, after an exponential backoff with jitter.
+
+    Like Task.retry(), this raises Retry, or exc if the task has
+    exhausted its retries. The countdown schedules the retry on the
+    broker, so no worker slot is held while waiting. If the order
+    could not be looked up in the first place (order is None), retry
+    with the original message.
+    """
+
+    if task.request.retries >= task.max_retries:
+        return
+
+    countdown = get_retry_countdown(task.request.retries)
+    if order is None:
+        logger.warning('Transient error looking up an order, '
+                       'retrying in %.1fs: %s' % (countdown, exc))
+        raise task.retry(countdown=countdown, exc=exc)
+
+    remaining = get_unprocessed_line_items(order, line_items)
+    logger.warning('Transient error processing order %s, retrying %d '
+                   'line item(s) in %.1fs: %s' % (order.id,
+                                                  len(remaining),
+                                                  countdown,
+                                                  exc))
+    raise task.retry(args=(pack_order(order.id, remaining), send_email),
+                     countdown=countdown,
+                     exc=exc)
+
+
+def get_retry_countdown(retries):
+    """Return the delay before the next retry: exponential in the number
+    of retries so far, capped, with half of it randomized so that
+    retries of many tasks failing together spread out.
+    """
+
+    delay = min(get_setting('retry_backoff', 2) * 2 ** retries,
+                get_setting('retry_backoff_max', 300))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def fan_out_order(order, line_items, chunk_size, send_email=False,
+                  resume=False, claim=None):
+    """Process the line items of an order in parallel, in chunks of
+    chunk_size items, as a chord of process_chunk tasks with a
+    finish_chunks callback. See start_order() for resume and claim.
+    """
+
+    if not start_order(order, logger, resume, claim):
+        return
+
+    # Record all OrderItems before fanning out, so that finish_chunks
+    # can tell from them whether all line items were processed
+    record_order_items(order, group_line_items(line_items))
+
+    chunks = chunk_line_items(line_items, chunk_size)
+    logger.info('Processing order %s in %d chunks' % (order.id,
+                                                      len(chunks)))
+    chord(
+        process_chunk.s(pack_order(order.id, chunk), send_email)
+        for chunk in chunks
+    )(finish_chunks.s(order.id))
+
+
+@shared_task(bind=True,
+             max_retries=3,
+             soft_time_limit=5)
+def process_chunk(self, data, send_email=False):
+    """Process a chunk of the line items of an order.
+
+    On a transient error, retry like process does. Otherwise, rather
+    than failing, which would abort the chord, log the error, mark the
+    chunk's unprocessed line items as ERROR, and return False.
+    """
+
+    order_id, line_items = unpack_order(data)
+    order = Order.objects.get(id=order_id)
+
+    try:
+        process_order_items(order, line_items, send_email, logger,
+                            notify=queue_enrollment_emails)
+    except Exception as exc:
+        if isinstance(exc, TRANSIENT_ERRORS):
+            retry_line_items(self, order, line_items, send_email, exc)
+        logger.error(exc, exc_info=True)
+        logger.error('Failed to process a chunk of '
+                     '%d line item(s) of order %s' % (len(line_items),
+                                                      order_id))
+        fail_order_items(order, line_items)
+        return False
+
+    return True
+
+
+@shared_task
+def finish_chunks(results, order_id):
+    """Set the final status of an order processed in chunks, once all
+    chunks are done.
+    """
+
+    order = finish_order(Order.objects.get(id=order_id))
+    logger.info('Finished processing order %s in %d chunks, '
+                'status: %s' % (order_id,
+                                len(results),
+                                order.get_status_display()))
+
+
+def queue_enrollment_emails(course_id, emails):
+    """Queue enrollment notification emails for a course, in batches of
+    email_batch_size, on the email_queue (if configured).
+    """
+
+    batch_size = get_setting('email_batch_size', 50)
+    for start in range(0, len(emails), batch_size):
+        notify_enrollments.apply_async(
+            (course_id, emails[start:start + batch_size]),
+            queue=get_setting('email_queue')
+        )
+
+
+@shared_task(bind=True,
+             max_retries=5,
+             default_retry_delay=60)
+def notify_enrollments(self, course_id, emails):
+    """Send enrollment notification emails for a batch of emails
+    enrolled in one course.
+
+    Emails are rate-limited across all workers (see
+    get_email_bucket()). Emails that can't be sent right away are
+    queued again for when the limit allows them, rather than
+    blocking the worker. On failure, retry with the emails not sent
+    yet.
+    """
+
+    bucket = get_email_bucket()
+    sent = 0
+    try:
+        for email in send_enrollment_emails(course_id, emails, bucket):
+            sent += 1
+    except Exception as exc:
+        logger.warning('Failed to send enrollment emails '
+                       'for %s, retrying: %s' % (course_id, exc))
+        raise self.retry(args=(course_id, emails[sent:]), exc=exc)
+
+    logger.info('Sent %d enrollment email(s) for %s' % (sent, course_id))
 
-    process_order(self.order, data, send_email, logger)
+    remaining = emails[sent:]
+    if remaining:
+        notify_enrollments.apply_async(
+            (course_id, remaining),
+            countdown=bucket.expected_time(min(len(remaining),
+                                               bucket.capacity)),
+            queue=get_setting('email_queue')
+        )
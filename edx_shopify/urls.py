@@ -1,8 +1,11 @@
 from django.conf.urls import url
 
-from .views import order_create
+from .views import order_create, order_metrics
 
 urlpatterns = [url(r'^shopify/order/create',
                    order_create,
                    name='shopify_order_create'),
+               url(r'^shopify/metrics$',
+                   order_metrics,
+                   name='shopify_metrics'),
 ]
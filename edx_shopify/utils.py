@@ -1,98 +1,577 @@
-import hashlib
-import base64
-import hmac
 import logging
+import sys
 
+from collections import OrderedDict
+
+from django.conf import settings
 from django.core.validators import validate_email
+from django.utils import six
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.contrib.auth.models import User
 from opaque_keys.edx.keys import CourseKey
 from courseware.courses import get_course_by_id
+from openedx.core.djangoapps.lang_pref import LANGUAGE_KEY
+from openedx.core.djangoapps.site_configuration import (
+    helpers as configuration_helpers
+)
+from openedx.core.djangoapps.user_api.models import UserPreference
 from lms.djangoapps.instructor.enrollment import (
-    get_user_email_language,
     enroll_email,
-    get_email_params
+    get_email_params,
+    send_mail_to_student
 )
 
+from . import metrics
+from .cache import course_cache, email_params_cache
+from .conf import get_setting
 from .models import Order, OrderItem
+from .payload import LineItem, get_line_item_email
+from .payload import encode_order, decode_order
+from .verify import WebhookVerifier
 
 
 def hmac_is_valid(key, msg, hmac_to_verify):
-    hash = hmac.new(str(key), str(msg), hashlib.sha256)
-    hmac_calculated = base64.b64encode(hash.digest())
-    return hmac.compare_digest(hmac_calculated, hmac_to_verify)
+    """Check a webhook signature against a single key. The webhook
+    view uses the verifier returned by verify.get_verifier() instead.
+    """
+    return WebhookVerifier([key]).is_valid(force_bytes(msg), hmac_to_verify)
 
 
 def record_order(data):
+    """Store an order, given an OrderData record (see
+    payload.load_order()).
+    """
+
     return Order.objects.get_or_create(
-        id=data['id'],
+        id=data.id,
         defaults={
-            'email': data['customer']['email'],
-            'first_name': data['customer']['first_name'],
-            'last_name': data['customer']['last_name']
+            'email': data.email,
+            'first_name': data.first_name,
+            'last_name': data.last_name,
+            'payload': encode_order(data)
         }
     )
 
 
-def process_order(order, data, send_email=False, logger=None):
+def bulk_record_orders(records, received=None):
+    """Store a batch of orders in bulk, given their OrderData records.
+
+    Orders that already exist (or repeat within the batch) are
+    skipped. New orders and their OrderItems are inserted with one
+    bulk insert each, in a single transaction.
+
+    received optionally maps order IDs to when the orders were
+    received, such as when they were created in Shopify for orders
+    recorded after the fact. Other orders are received now.
+
+    Return the OrderData records of the new orders.
+    """
+
+    existing = set(Order.objects.filter(
+        id__in=[data.id for data in records]
+    ).values_list('id', flat=True))
+
+    new = []
+    for data in records:
+        if data.id not in existing:
+            existing.add(data.id)
+            new.append(data)
+
+    received = received or {}
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            Order.objects.bulk_create([
+                Order(id=data.id,
+                      email=data.email,
+                      first_name=data.first_name,
+                      last_name=data.last_name,
+                      received=received.get(data.id) or now,
+                      payload=encode_order(data))
+                for data in new
+            ])
+            OrderItem.objects.bulk_create([
+                OrderItem(order_id=data.id, sku=sku, email=email)
+                for data in new
+                for sku, emails in group_line_items(data.line_items).items()
+                for email in emails
+            ])
+    except IntegrityError:
+        # Some of the orders were recorded since we looked, typically
+        # by a webhook: fall back to recording them one at a time
+        new = [data for data in new
+               if record_order_with_items(data, received.get(data.id) or now)]
+
+    return new
+
+
+def record_order_with_items(data, received):
+    """Store an order received at the given time, and its OrderItems,
+    unless it already exists. Return True if it was stored.
+    """
+
+    with transaction.atomic():
+        order, created = Order.objects.get_or_create(
+            id=data.id,
+            defaults={
+                'email': data.email,
+                'first_name': data.first_name,
+                'last_name': data.last_name,
+                'received': received,
+                'payload': encode_order(data)
+            }
+        )
+        if created:
+            OrderItem.objects.bulk_create([
+                OrderItem(order_id=data.id, sku=sku, email=email)
+                for sku, emails in group_line_items(data.line_items).items()
+                for email in emails
+            ])
+    return created
+
+
+def process_order(order, line_items, send_email=False, logger=None,
+                  notify=None, resume=False, claim=None):
+    """Process an order, given a list of (sku, email) line item pairs.
+
+    If send_email is set, students are enrolled without being emailed
+    right away. Instead, once their enrollments are committed, notify
+    (sku, emails) is called with each batch of enrolled emails, so
+    that notifications can be sent separately (see
+    tasks.notify_enrollments). Without a notify callable, the
+    notifications are sent right here, after the commit.
+
+    See start_order() for resume and claim.
+    """
+
+    if not logger:
+        logger = logging
+
+    if not start_order(order, logger, resume, claim):
+        return
+
+    with metrics.timer('order.process'):
+        process_order_items(order, line_items, send_email, logger, notify,
+                            mark_processed=True)
+
+    metrics.incr('order.processed')
+    return order
+
+
+def start_order(order, logger=None, resume=False, claim=None):
+    """Claim an order for processing, marking it as PROCESSING.
+
+    The claim is a single conditional UPDATE, which only succeeds if
+    the order is still UNPROCESSED in the database, whatever the order
+    object says. Of several workers handed the same order, only one
+    can claim it. Return False if the claim fails, in which case the
+    order must not be processed.
+
+    The claim is recorded in the order's claimed_by field, typically
+    as the ID of the task processing it, and its time in the claimed
+    field (see get_stuck_orders()). With resume, also pick up an
+    order that is PROCESSING under that same claim, as left behind by
+    an earlier, failed attempt of the same task, but not one that
+    someone else has claimed since.
+    """
+
     if not logger:
         logger = logging
 
-    # If the order is anything but UNPROCESSED, abandon the attempt.
-    if order.status != Order.UNPROCESSED:
+    claimable = Q(status=Order.UNPROCESSED)
+    if resume:
+        claimable |= Q(status=Order.PROCESSING, claimed_by=claim)
+
+    now = timezone.now()
+    claimed = Order.objects.filter(
+        claimable,
+        id=order.id
+    ).update(status=Order.PROCESSING, claimed_by=claim, claimed=now)
+
+    # If the order is anything else, abandon the attempt.
+    if not claimed:
         logger.warning('Order %s has already '
                        'been processed, ignoring' % order.id)
-        return
+        return False
 
-    # Mark the order as being processed.
     order.status = Order.PROCESSING
-    order.save()
+    order.claimed_by = claim
+    order.claimed = now
+    return True
+
 
-    # Process line items
-    for item in data['line_items']:
-        process_line_item(order, item)
-        logger.debug('Successfully processed line item '
-                     '%s for order %s' % (item, order.id))
+def get_stuck_orders(stuck_before):
+    """Return a Q object matching the orders that have been PROCESSING
+    since before the given time, which have most likely been left
+    behind by a crashed worker.
+
+    This goes by when the order was claimed, not when it was received,
+    so that an old order that is being processed right now (say, after
+    being reprocessed) does not count as stuck. Orders claimed before
+    claims were timestamped go by when they were received.
+    """
+
+    stuck = Q(claimed__lt=stuck_before)
+    unclaimed = Q(claimed__isnull=True, received__lt=stuck_before)
+    return Q(status=Order.PROCESSING) & (stuck | unclaimed)
+
+
+def process_order_items(order, line_items, send_email=False, logger=None,
+                        notify=None, mark_processed=False):
+    """Process (sku, email) line item pairs of an order that is being
+    processed: either all of them, or a chunk.
+
+    Record the line items up front, then process them per course, in
+    batches of at most enrollment_batch_size emails, all in a single
+    transaction with a savepoint per batch. If anything fails (say, a
+    soft time limit expires in the middle of a course), only the
+    failing batch's changes are rolled back: the batches processed
+    before it are committed, so that a retry picks up where this left
+    off, and then the error is raised.
+
+    With mark_processed, also mark the order as PROCESSED in the same
+    transaction, once all batches are processed. See process_order()
+    for send_email and notify; notifications are only passed on once
+    the transaction is committed, for the batches that were kept, so
+    that no student is emailed about an enrollment that was rolled
+    back.
+    """
+
+    if not logger:
+        logger = logging
+
+    if send_email and notify is None:
+        notify = send_enrollment_emails_now
+
+    batch_size = get_setting('enrollment_batch_size', 50)
+    groups = group_line_items(line_items)
+    notifications = []
+    exc_info = None
+    with transaction.atomic():
+        statuses = record_order_items(order, groups)
+        try:
+            for sku, emails in groups.items():
+                pending = [email for email in emails
+                           if statuses[(sku, email)] != OrderItem.PROCESSED]
+                for start in range(0, len(pending), batch_size):
+                    # Hold back the batch's notifications until we
+                    # know whether its changes are kept
+                    batch_notifications = []
+
+                    def collect(sku, enrolled):
+                        batch_notifications.append((sku, enrolled))
+
+                    with transaction.atomic():
+                        process_line_items(order, sku,
+                                           pending[start:start + batch_size],
+                                           send_email, collect)
+                    notifications.extend(batch_notifications)
+
+                logger.debug('Successfully processed %d line item(s) '
+                             'for %s in order %s' % (len(emails), sku,
+                                                     order.id))
+        except Exception:
+            exc_info = sys.exc_info()
+
+        if transaction.get_rollback():
+            # The failure left the transaction unusable (say, after a
+            # deadlock), so none of its changes are kept
+            notifications = []
+        elif mark_processed and exc_info is None:
+            order.status = Order.PROCESSED
+            order.save(update_fields=['status'])
+
+    for sku, enrolled in notifications:
+        notify(sku, enrolled)
+
+    if exc_info is not None:
+        six.reraise(*exc_info)
 
-    # Mark the order status
-    order.status = Order.PROCESSED
-    order.save()
+
+def finish_order(order):
+    """Set the final status of an order from its OrderItems: PROCESSED
+    if all of them are processed, ERROR otherwise.
+    """
+
+    unfinished = OrderItem.objects.filter(
+        order=order
+    ).exclude(
+        status=OrderItem.PROCESSED
+    ).exists()
+
+    order.status = Order.ERROR if unfinished else Order.PROCESSED
+    order.save(update_fields=['status'])
 
     return order
 
 
+def fail_order_items(order, line_items):
+    """Mark the unprocessed OrderItems among a list of (sku, email) line
+    item pairs as ERROR.
+    """
+
+    for sku, emails in group_line_items(line_items).items():
+        OrderItem.objects.filter(
+            order=order,
+            sku=sku,
+            email__in=emails,
+            status=OrderItem.UNPROCESSED
+        ).update(status=OrderItem.ERROR)
+
+
+def get_unprocessed_line_items(order, line_items):
+    """Return the distinct (sku, email) line item pairs among line_items
+    whose OrderItems have not been processed.
+    """
+
+    processed = set(OrderItem.objects.filter(
+        order=order,
+        status=OrderItem.PROCESSED
+    ).values_list('sku', 'email'))
+
+    return [LineItem(sku, email)
+            for sku, emails in group_line_items(line_items).items()
+            for email in emails
+            if (sku, email) not in processed]
+
+
+def reset_order(order_id, status):
+    """Reset an order in the given status (typically ERROR, or PROCESSING
+    after a worker crash) to UNPROCESSED, so that it can be processed
+    again, along with its failed OrderItems.
+
+    The reset only happens if the order is still in that status, and
+    has OrderItems or a stored payload to tell what its line items
+    are. Return the (sku, email) pairs still to be processed, or None
+    if the order was not reset.
+    """
+
+    return reset_orders([order_id], status).get(order_id)
+
+
+def reset_orders(order_ids, status):
+    """Reset a batch of orders in the given status, like reset_order(),
+    in a fixed number of queries, however many orders there are.
+
+    Return a dictionary mapping the IDs of the orders that were reset
+    to their (sku, email) pairs still to be processed.
+    """
+
+    with transaction.atomic():
+        # Lock the orders that are still in that status, so that
+        # their status can't change under us until they are reset
+        order_ids = list(Order.objects.select_for_update().filter(
+            id__in=order_ids,
+            status=status
+        ).values_list('id', flat=True))
+        if not order_ids:
+            return {}
+
+        items = OrderItem.objects.filter(
+            order_id__in=order_ids
+        ).order_by('id').values_list('order_id', 'sku', 'email', 'status')
+
+        line_items = {}
+        for order_id, sku, email, item_status in items:
+            pairs = line_items.setdefault(order_id, [])
+            if item_status != OrderItem.PROCESSED:
+                pairs.append(LineItem(sku, email))
+
+        # Orders that failed before their OrderItems were recorded:
+        # fall back to their stored payload, if any
+        missing = [order_id for order_id in order_ids
+                   if order_id not in line_items]
+        if missing:
+            payloads = Order.objects.filter(
+                id__in=missing,
+                payload__isnull=False
+            ).values_list('id', 'payload')
+            for order_id, payload in payloads:
+                line_items[order_id] = decode_order(payload).line_items
+
+        if not line_items:
+            return {}
+
+        Order.objects.filter(
+            id__in=list(line_items)
+        ).update(status=Order.UNPROCESSED)
+        OrderItem.objects.filter(
+            order_id__in=list(line_items),
+            status=OrderItem.ERROR
+        ).update(status=OrderItem.UNPROCESSED)
+
+    return line_items
+
+
+def chunk_line_items(line_items, chunk_size):
+    """Split (sku, email) line item pairs into chunks of at most
+    chunk_size distinct pairs, keeping pairs for the same SKU together
+    as far as possible.
+    """
+
+    pairs = [(sku, email)
+             for sku, emails in group_line_items(line_items).items()
+             for email in emails]
+    return [pairs[start:start + chunk_size]
+            for start in range(0, len(pairs), chunk_size)]
+
+
+def group_line_items(line_items):
+    """Group (sku, email) line item pairs by SKU.
+
+    Return an OrderedDict mapping each SKU to the list of distinct
+    emails to enroll, both in the order in which they first appear.
+    """
+
+    groups = OrderedDict()
+    for sku, email in line_items:
+        emails = groups.setdefault(sku, [])
+        if email not in emails:
+            emails.append(email)
+    return groups
+
+
+def record_order_items(order, groups):
+    """Store the OrderItems for an order in bulk.
+
+    Fetch all existing OrderItems of the order in one query, and
+    create the missing ones with a single bulk insert. groups maps
+    SKUs to lists of emails, as returned by group_line_items().
+
+    Return a dictionary mapping (sku, email) tuples to OrderItem
+    statuses.
+    """
+
+    statuses = dict(
+        ((sku, email), status) for sku, email, status in
+        OrderItem.objects.filter(order=order).values_list('sku',
+                                                          'email',
+                                                          'status')
+    )
+
+    missing = [OrderItem(order=order, sku=sku, email=email)
+               for sku, emails in groups.items()
+               for email in emails
+               if (sku, email) not in statuses]
+    if missing:
+        OrderItem.objects.bulk_create(missing)
+        for order_item in missing:
+            statuses[(order_item.sku, order_item.email)] = order_item.status
+
+    return statuses
+
+
+def process_line_items(order, sku, emails, send_email=False, notify=None):
+    """Process a batch of line items of an order that share a SKU.
+
+    Enroll all emails in one batch, and mark their OrderItems (which
+    must already exist, see record_order_items()) as processed with a
+    single UPDATE. If an enrollment fails, the OrderItems enrolled up
+    to that point are still marked processed (and their notification
+    passed on to notify) before the error is propagated, to be handled
+    up the stack. Note that process_order_items() runs each batch in a
+    savepoint, and rolls all of that back, enrollments included, when
+    the batch fails: the partial progress only sticks when this is
+    called outside of a transaction.
+
+    With send_email but no notify callable, students are emailed as
+    part of their enrollment, which cannot be taken back: only do that
+    outside of a transaction.
+
+    Return the list of enrolled emails.
+    """
+
+    enrolled = []
+    if not emails:
+        return enrolled
+
+    email_students = send_email and notify is None
+    try:
+        for email in auto_enroll_emails(sku, emails, email_students):
+            enrolled.append(email)
+    finally:
+        if enrolled:
+            OrderItem.objects.filter(
+                order=order,
+                sku=sku,
+                email__in=enrolled
+            ).update(status=OrderItem.PROCESSED)
+            if send_email and notify is not None:
+                notify(sku, enrolled)
+
+    return enrolled
+
+
 def process_line_item(order, item):
     """Process a line item of an order.
 
     Extract sku and properties.email, create an OrderItem, create an
     enrollment, and mark the OrderItem as processed. Propagate any
     errors, to be handled up the stack.
+
+    The course is resolved through the course cache (see
+    get_course()), so several line items for the same course only
+    load it once per worker.
     """
 
     # Fetch relevant fields from the item
     sku = item['sku']
-    email = next(
-        p['value'] for p in item['properties']
-        if p['name'] == 'email'
-    )
+    email = get_line_item_email(item)
 
-    # Store line item, prop
-    order_item, created = OrderItem.objects.get_or_create(
-        order=order,
-        sku=sku,
-        email=email
-    )
+    with metrics.timer('line_item.process'):
+        # Store line item, prop
+        order_item, created = OrderItem.objects.get_or_create(
+            order=order,
+            sku=sku,
+            email=email
+        )
 
-    # Create an enrollment for the line item
-    if order_item.status == OrderItem.UNPROCESSED:
-        auto_enroll_email(sku, email)
+        # Create an enrollment for the line item
+        if order_item.status == OrderItem.UNPROCESSED:
+            auto_enroll_email(sku, email)
 
-    # Mark the item as processed
-    order_item.status = OrderItem.PROCESSED
-    order_item.save()
+        # Mark the item as processed
+        order_item.status = OrderItem.PROCESSED
+        order_item.save(update_fields=['status'])
 
     return order_item
 
 
+def get_course(course_id):
+    """Look up a course by its course ID string.
+
+    Return a (CourseKey, course) tuple. Courses are served from the
+    per-worker course cache, so that repeated seats for the same
+    course don't each trigger a full modulestore load. Raises Http404
+    if the course does not exist (and does not cache that outcome).
+    """
+
+    course_key = CourseKey.from_string(course_id)
+    course = course_cache.get(course_key, get_course_by_id)
+    return course_key, course
+
+
+def get_course_email_params(course):
+    """Return the parameters for enrollment emails for a course.
+
+    They only depend on the course and the site, so they are served
+    from the per-worker email parameters cache, keyed by both. The
+    caller gets its own copy, as enroll_email() adds student details
+    to the parameters it is given.
+    """
+
+    site_name = configuration_helpers.get_value('SITE_NAME',
+                                                settings.SITE_NAME)
+    params = email_params_cache.get(
+        (course.id, site_name),
+        lambda key: get_email_params(course, True, secure=True)
+    )
+    return dict(params)
+
+
 def auto_enroll_email(course_id,
                       email,
                       send_email=True):
@@ -101,32 +580,117 @@ def auto_enroll_email(course_id,
 
     Based on lms.djangoapps.instructor.views.api.students_update_enrollment()
     """
+    with metrics.timer('enroll.email'):
+        list(auto_enroll_emails(course_id, [email], send_email))
+
+
+def auto_enroll_emails(course_id,
+                       emails,
+                       send_email=True):
+    """
+    Auto-enroll a batch of emails in one course.
+
+    Like students_update_enrollment(), validate all emails, load the
+    course and the email parameters once, and then enroll each email
+    in turn. This is a generator: it yields each email as soon as it
+    has been enrolled, so callers can keep track of partial progress
+    if a later enrollment fails.
+    """
+    emails = list(emails)
+
     # Raises ValidationError if invalid
-    validate_email(email)
+    for email in emails:
+        validate_email(email)
 
-    course_id = CourseKey.from_string(course_id)
-    course = get_course_by_id(course_id)
+    with metrics.timer('enroll.course_load'):
+        course_id, course = get_course(course_id)
 
-    # If we want to notify the newly enrolled student by email, fetch
-    # the required parameters
+    # If we want to notify the newly enrolled students by email,
+    # fetch the required parameters
     email_params = None
-    language = None
+    languages = {}
     if send_email:
-        email_params = get_email_params(course, True, secure=True)
+        with metrics.timer('enroll.email_params'):
+            email_params = get_course_email_params(course)
+            languages = get_email_languages(emails)
 
-        # Try to find out what language to send the email in.
-        user = None
-        try:
-            user = User.objects.get(email=email)
-        except User.DoesNotExist:
-            pass
+    for email in emails:
+        # Enroll the email (and, with send_email, email the student)
+        with metrics.timer('enroll.enroll_email'):
+            enroll_email(course_id,
+                         email,
+                         auto_enroll=True,
+                         email_students=send_email,
+                         email_params=email_params,
+                         language=languages.get(email))
+        metrics.incr('enroll.enrolled')
+        yield email
+
+
+def get_email_languages(emails):
+    """Try to find out what language to send emails in.
+
+    Return a dictionary mapping the emails of existing users who have
+    set a preferred language to that language. This takes a single
+    query, however many emails there are.
+    """
+
+    return dict(UserPreference.objects.filter(
+        user__email__in=emails,
+        key=LANGUAGE_KEY
+    ).values_list('user__email', 'value'))
+
+
+def get_email_users(emails):
+    """Return a dictionary mapping the emails of existing users to
+    their User objects, with their profiles, in a single query.
+    """
+
+    return dict((user.email, user) for user in User.objects.filter(
+        email__in=emails
+    ).select_related('profile'))
+
+
+def send_enrollment_emails_now(course_id, emails):
+    """Send enrollment notification emails for a batch of emails
+    enrolled in one course, in this process (see
+    send_enrollment_emails()).
+    """
+    for email in send_enrollment_emails(course_id, emails):
+        pass
+
+
+def send_enrollment_emails(course_id, emails, bucket=None):
+    """
+    Send enrollment notification emails for a batch of emails that
+    have already been enrolled in one course.
+
+    This sends the same messages as enroll_email(..., email_students=True),
+    but separately from the enrollment itself. If a token bucket (such
+    as ratelimit.RateLimiter) is given, each email consumes a token,
+    and sending stops early once the bucket runs dry.
+
+    This is a generator: it yields each email as soon as its message
+    has been sent.
+    """
+    course_id, course = get_course(course_id)
+    email_params = get_course_email_params(course)
+    languages = get_email_languages(emails)
+    users = get_email_users(emails)
+
+    for email in emails:
+        if bucket is not None and not bucket.can_consume(1):
+            return
+
+        params = dict(email_params, email_address=email)
+        user = users.get(email)
+        if user:
+            params['message_type'] = 'enrolled_enroll'
+            params['full_name'] = user.profile.name
         else:
-            language = get_user_email_language(user)
-
-    # Enroll the email
-    enroll_email(course_id,
-                 email,
-                 auto_enroll=True,
-                 email_students=send_email,
-                 email_params=email_params,
-                 language=language)
+            params['message_type'] = 'allowed_enroll'
+        with metrics.timer('email.send'):
+            send_mail_to_student(email, params,
+                                 language=languages.get(email))
+        metrics.incr('email.sent')
+        yield email
@@ -1,11 +1,18 @@
-import json
-
 from django.conf import settings
+from django.db import transaction
 from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 
-from .utils import hmac_is_valid, record_order
+from . import metrics
+from .conf import get_setting
+from .deliveries import is_redelivery, mark_delivered
+from .messages import pack_order
+from .payload import parse_order, PayloadError
+from .prometheus import CONTENT_TYPE, render_metrics
+from .utils import record_order
+from .verify import get_verifier
 from .models import Order
 from .tasks import process
 
@@ -13,6 +20,14 @@ from .tasks import process
 @csrf_exempt
 @require_POST
 def order_create(request):
+    with metrics.timer('webhook'):
+        response = handle_order_create(request)
+    metrics.incr('webhook.status.%d' % response.status_code)
+    return response
+
+
+def handle_order_create(request):
+    "Handle an order creation webhook, see order_create()."
     # Load configuration
     conf = settings.WEBHOOK_SETTINGS['edx_shopify']
 
@@ -20,17 +35,31 @@ def order_create(request):
     try:
         hmac = request.META['HTTP_X_SHOPIFY_HMAC_SHA256']
         shop_domain = request.META['HTTP_X_SHOPIFY_SHOP_DOMAIN']
-        data = json.loads(request.body)
-    except (KeyError, ValueError):
+    except KeyError:
         return HttpResponse(status=400)
 
-    if ((not hmac_is_valid(conf['api_key'],
-                           request.body,
-                           hmac)) or (conf['shop_domain'] != shop_domain)):
+    with metrics.timer('webhook.verify'):
+        valid = get_verifier().is_valid(request.body, hmac)
+    if (not valid) or (conf['shop_domain'] != shop_domain):
         return HttpResponse(status=403)
 
+    # Acknowledge redeliveries of a webhook we have already handled,
+    # without looking at the payload again
+    webhook_id = request.META.get('HTTP_X_SHOPIFY_WEBHOOK_ID')
+    if webhook_id and is_redelivery(webhook_id):
+        return HttpResponse(status=200)
+
+    # Parse the payload into the order data we need, rejecting
+    # malformed payloads
+    try:
+        with metrics.timer('webhook.parse'):
+            data = parse_order(request.body)
+    except PayloadError:
+        return HttpResponse(status=400)
+
     # Record order
-    order, created = record_order(data)
+    with metrics.timer('webhook.record'):
+        order, created = record_order(data)
 
     send_email = True
     try:
@@ -38,8 +67,34 @@ def order_create(request):
     except KeyError:
         pass
 
-    # Process order
+    # Process order, passing on only the order ID and line items
     if order.status == Order.UNPROCESSED:
-        process.delay(data, send_email)
+        with metrics.timer('webhook.publish'):
+            process.delay(pack_order(data.id, data.line_items), send_email)
+
+    # Only remember the webhook as handled once the order is safely
+    # stored, so that a redelivery still gets through if storing it
+    # failed
+    if webhook_id:
+        transaction.on_commit(lambda: mark_delivered(webhook_id))
 
     return HttpResponse(status=200)
+
+
+@require_GET
+def order_metrics(request):
+    """Expose order pipeline metrics to Prometheus.
+
+    Scrapes must present the metrics_token setting as a bearer token.
+    Without a metrics_token, the endpoint is disabled, so as not to
+    publish order volumes on a public LMS URL.
+    """
+    token = get_setting('metrics_token')
+    if not token:
+        return HttpResponse(status=404)
+    if not constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''),
+            'Bearer %s' % token):
+        return HttpResponse(status=403)
+
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
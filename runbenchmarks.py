@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import sys
+import os
+from importlib import import_module
+from optparse import OptionParser
+import contracts
+
+contracts.disable_all()
+
+# Add Open edX common and LMS Django apps to PYTHONPATH
+sys.path.append(os.path.join(os.path.dirname(__file__),
+                             'edx-platform'))
+for directory in ['common', 'lms']:
+    sys.path.append(os.path.join(os.path.dirname(__file__),
+                                 'edx-platform',
+                                 directory,
+                                 'djangoapps'))
+for lib in ['xmodule', 'dogstats', 'capa', 'calc', 'chem']:
+    sys.path.append(os.path.join(os.path.dirname(__file__),
+                                 'edx-platform',
+                                 'common',
+                                 'lib',
+                                 lib))
+
+# This envar must be set before setting up Django, silence flake8
+# E402 ("module level import not at top of file").
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_settings")
+import django  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import (setup_test_environment,  # noqa: E402
+                               teardown_test_environment)
+
+# Benchmark modules in the benchmarks package that need Django and a
+# test database. Each has a run() function, returning the number of
+# failed checks; benchmarks that compare against stored baselines
+# rewrite them instead if update_baselines is set.
+BENCHMARKS = ['webhook', 'process_order']
+
+
+def run_benchmarks(*names, **kwargs):
+    if not names:
+        names = BENCHMARKS
+
+    django.setup()
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+
+    failures = 0
+    try:
+        for name in names:
+            module = import_module('benchmarks.%s' % name)
+            failures += module.run(**kwargs)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    if failures > 0:
+        sys.exit(failures)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('--update-baselines',
+                      action='store_true',
+                      default=False,
+                      help='Store the results as the new baselines')
+    (options, args) = parser.parse_args()
+    run_benchmarks(*args, update_baselines=options.update_baselines)
@@ -2,17 +2,27 @@
 import json
 import os
 
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, override_settings
 
 from opaque_keys.edx.keys import CourseKey
 from opaque_keys.edx.locator import BlockUsageLocator
 
+from edx_shopify.cache import course_cache, email_params_cache
+from edx_shopify.payload import load_order
+
 try:
     from unittest.mock import Mock
 except ImportError:
     from mock import Mock
 
 
+def shopify_settings(**kwargs):
+    "Return settings with additional edx_shopify settings."
+    conf = dict(settings.WEBHOOK_SETTINGS['edx_shopify'], **kwargs)
+    return override_settings(WEBHOOK_SETTINGS={'edx_shopify': conf})
+
+
 class ShopifyTestCase(TestCase):
 
     def setup_payload(self):
@@ -22,8 +32,14 @@ class ShopifyTestCase(TestCase):
                                     'post.json')
         self.raw_payload = open(payload_file, 'r').read()
         self.json_payload = json.loads(self.raw_payload)
+        self.order_data = load_order(self.json_payload)
 
     def setup_course(self):
+        # Start from empty course and email parameter caches, so that
+        # mock courses from one test don't leak into another
+        course_cache.clear()
+        email_params_cache.clear()
+
         # Set up a mock course
         course_id_string = 'course-v1:org+course+run1'
         ck = CourseKey.from_string(course_id_string)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.contrib.admin.sites import AdminSite
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from edx_shopify import admin
+from edx_shopify.models import Order, OrderItem
+from edx_shopify.utils import record_order, reset_orders
+
+from . import ShopifyTestCase
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+
+class OrderAdminTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_course()
+        self.site = AdminSite()
+        self.order_admin = admin.OrderAdmin(Order, self.site)
+        self.item_admin = admin.OrderItemAdmin(OrderItem, self.site)
+        self.request = RequestFactory().get('/')
+
+    def make_order(self, order_id, email, status, claimed=None):
+        order, created = record_order(
+            self.order_data._replace(id=order_id, email=email))
+        order.status = status
+        order.claimed = claimed
+        order.save()
+        OrderItem.objects.create(order=order,
+                                 sku='course-v1:org+course+run1',
+                                 email=email)
+        return order
+
+    def search(self, model_admin, search_term):
+        queryset, use_distinct = model_admin.get_search_results(
+            self.request, model_admin.model.objects.all(), search_term)
+        self.assertFalse(use_distinct)
+        return queryset
+
+    def test_search(self):
+        self.make_order(1, 'one@example.com', Order.PROCESSED)
+        self.make_order(12, 'two@example.com', Order.ERROR)
+
+        # Numbers match order IDs exactly, not as a substring
+        self.assertEqual([o.id for o in self.search(self.order_admin, '1')],
+                         [1])
+        self.assertEqual(
+            [o.id for o in self.search(self.order_admin, ' two@example.com')],
+            [12])
+        # No partial email matches
+        self.assertFalse(self.search(self.order_admin, 'example.com'))
+        self.assertEqual(self.search(self.order_admin, '').count(), 2)
+
+        items = self.search(self.item_admin, '12')
+        self.assertEqual([i.order_id for i in items], [12])
+        items = self.search(self.item_admin, 'one@example.com')
+        self.assertEqual([i.order_id for i in items], [1])
+
+    def test_capped_count(self):
+        for order_id in range(1, 6):
+            self.make_order(order_id, 'learner%d@example.com' % order_id,
+                            Order.PROCESSED)
+
+        with patch.object(admin.CappedCountPaginator, 'max_count', 3):
+            paginator = admin.CappedCountPaginator(
+                Order.objects.order_by('id'), 2)
+            with self.assertNumQueries(1):
+                self.assertEqual(paginator.count, 3)
+        self.assertEqual(paginator.num_pages, 2)
+        self.assertEqual([o.id for o in paginator.page(2)], [3])
+
+    def test_requeue_orders(self):
+        two_hours_ago = timezone.now() - timedelta(hours=2)
+        self.make_order(1, 'one@example.com', Order.PROCESSED)
+        self.make_order(2, 'two@example.com', Order.ERROR)
+        self.make_order(3, 'three@example.com', Order.UNPROCESSED)
+        # An order that a worker is processing right now must be left
+        # alone, but not one that has been stuck for a while
+        self.make_order(4, 'four@example.com', Order.PROCESSING,
+                        claimed=timezone.now())
+        self.make_order(5, 'five@example.com', Order.PROCESSING,
+                        claimed=two_hours_ago)
+        self.make_order(6, 'six@example.com', Order.ERROR)
+
+        requeued = []
+
+        def requeue_orders(order_ids, status, send_email):
+            requeued.append((sorted(order_ids), status))
+            # Pretend that order 6 changed state in the meantime
+            return [i for i in order_ids if i != 6]
+
+        self.order_admin.message_user = Mock()
+        with patch.multiple(admin,
+                            requeue_orders=Mock(side_effect=requeue_orders),
+                            REQUEUE_CHUNK_SIZE=2):
+            self.order_admin.requeue_selected_orders(self.request,
+                                                     Order.objects.all())
+
+        # Orders are requeued in batches by status
+        self.assertEqual(sorted(requeued),
+                         [([2, 6], Order.ERROR),
+                          ([3], Order.UNPROCESSED),
+                          ([5], Order.PROCESSING)])
+        message = self.order_admin.message_user.call_args[0][1]
+        self.assertTrue(message.startswith(
+            'Requeued 3 order(s), skipped 1 whose state changed.'))
+
+    def test_reset_orders(self):
+        for order_id in range(1, 5):
+            self.make_order(order_id, 'learner%d@example.com' % order_id,
+                            Order.ERROR)
+        self.make_order(5, 'five@example.com', Order.PROCESSED)
+        OrderItem.objects.filter(order_id=2).update(status=OrderItem.ERROR)
+
+        # Resetting a batch takes the same number of queries, however
+        # many orders there are
+        with CaptureQueriesContext(connection) as single:
+            reset_orders([4], Order.ERROR)
+        with self.assertNumQueries(len(single)):
+            line_items = reset_orders([1, 2, 3, 5], Order.ERROR)
+
+        self.assertEqual(sorted(line_items), [1, 2, 3])
+        self.assertEqual(line_items[2], [('course-v1:org+course+run1',
+                                          'learner2@example.com')])
+        self.assertEqual(
+            set(Order.objects.values_list('status', flat=True)),
+            {Order.UNPROCESSED, Order.PROCESSED})
+        self.assertFalse(OrderItem.objects.filter(
+            status=OrderItem.ERROR).exists())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import override_settings
+from django.utils.dateparse import parse_datetime
+from django.utils.six import StringIO
+from django.utils.six.moves import BaseHTTPServer
+from django.utils.six.moves.urllib.parse import parse_qs, urlparse
+
+from edx_shopify.api import get_orders_url
+from edx_shopify.models import Order, OrderItem
+from edx_shopify.utils import record_order
+
+from . import ShopifyTestCase
+
+
+class FakeShopifyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Serve the pages of orders of a FakeShopifyServer."
+
+    # Keep connections alive between requests, like Shopify does
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.client_address,
+                                self.headers.get('X-Shopify-Access-Token')))
+
+        if server.fail:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        query = parse_qs(urlparse(self.path).query)
+        page = int(query.get('page_info', ['0'])[0])
+        body = json.dumps({'orders': server.pages[page]}).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if page + 1 < len(server.pages):
+            self.send_header('Link',
+                             '<%s?limit=250&page_info=%d>; rel="next"' % (
+                                 server.url, page + 1))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeShopifyServer(BaseHTTPServer.HTTPServer):
+    """A local stand-in for the Shopify Orders API, serving a fixed
+    list of pages with cursor pagination.
+    """
+
+    def __init__(self, pages):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeShopifyHandler)
+        self.pages = pages
+        self.requests = []
+        self.fail = False
+        self.url = 'http://127.0.0.1:%d/admin/api/2020-01/orders.json' % (
+            self.server_address[1])
+
+
+class BackfillOrdersTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+
+        pages = [[dict(self.json_payload, id=order_id)
+                  for order_id in range(page * 3, page * 3 + 3)]
+                 for page in range(100, 103)]
+        self.server = FakeShopifyServer(pages)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        settings = override_settings(WEBHOOK_SETTINGS={
+            'edx_shopify': {
+                'shop_domain': 'example.com',
+                'api_key': 'foobar',
+                'access_token': 'secret',
+                'api_url': self.server.url.rsplit('/', 1)[0],
+            }
+        })
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def backfill(self, *args):
+        out = StringIO()
+        call_command('backfill_orders', *args, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_orders_url(self):
+        self.assertEqual(get_orders_url(), self.server.url)
+        with override_settings(WEBHOOK_SETTINGS={
+                'edx_shopify': {'shop_domain': 'example.com'}}):
+            self.assertEqual(get_orders_url(),
+                             'https://example.com/admin/api/2020-01/'
+                             'orders.json')
+
+    def test_backfill(self):
+        # Orders already recorded from webhooks are skipped
+        record_order(self.order_data._replace(id=301))
+        record_order(self.order_data._replace(id=305))
+
+        out = self.backfill('--status=open')
+
+        self.assertEqual(Order.objects.count(), 9)
+        self.assertEqual(OrderItem.objects.count(), 14)
+        self.assertIn('fetched 9 order(s), recorded 7 missing', out)
+        self.assertNotIn('Recorded missing order 301', out)
+        self.assertIn('Recorded missing order 302', out)
+
+        # All pages were fetched over a single, authenticated
+        # connection, with the filters applied to the first request
+        self.assertEqual(len(self.server.requests), 3)
+        paths, clients, tokens = zip(*self.server.requests)
+        self.assertEqual(len(set(clients)), 1)
+        self.assertEqual(set(tokens), {'secret'})
+        self.assertIn('status=open', paths[0])
+        self.assertIn('page_info=2', paths[2])
+
+    def test_cancelled(self):
+        self.server.pages[0][1]['cancelled_at'] = '2017-04-10T10:00:00Z'
+
+        out = self.backfill()
+        self.assertIn('skipped 1 cancelled', out)
+        self.assertFalse(Order.objects.filter(id=301).exists())
+
+        self.backfill('--include-cancelled')
+        self.assertTrue(Order.objects.filter(id=301).exists())
+
+    def test_received(self):
+        # Backfilled orders were received when they were placed
+        self.backfill()
+        self.assertEqual(Order.objects.get(id=300).received,
+                         parse_datetime(self.json_payload['created_at']))
+
+    def test_fetch_error(self):
+        self.server.fail = True
+        with self.assertRaises(CommandError):
+            self.backfill()
+        self.assertEqual(Order.objects.count(), 0)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from django.test import TestCase
+
+from edx_shopify.cache import LRUCache, course_cache, email_params_cache
+from edx_shopify.signals import invalidate_course_cache
+from edx_shopify.signals import invalidate_email_params_cache
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+
+class LRUCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache(maxsize=2, ttl=60)
+
+    def test_hit_and_miss(self):
+        loader = Mock(return_value='value')
+
+        self.assertEqual(self.cache.get('key', loader), 'value')
+        self.assertEqual(self.cache.get('key', loader), 'value')
+
+        # The loader must only have been invoked on the first lookup
+        loader.assert_called_once_with('key')
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_size_bound(self):
+        loader = Mock(side_effect=lambda key: key.upper())
+
+        self.cache.get('a', loader)
+        self.cache.get('b', loader)
+        # Touch 'a', so that 'b' is the least recently used entry
+        self.cache.get('a', loader)
+        self.cache.get('c', loader)
+
+        self.assertEqual(self.cache.stats()['size'], 2)
+        loader.reset_mock()
+        self.cache.get('a', loader)
+        self.assertFalse(loader.called)
+        self.cache.get('b', loader)
+        loader.assert_called_once_with('b')
+
+    def test_expiry(self):
+        loader = Mock(return_value='value')
+
+        with patch('edx_shopify.cache.time.time', return_value=1000):
+            self.cache.get('key', loader)
+        with patch('edx_shopify.cache.time.time', return_value=1059):
+            self.cache.get('key', loader)
+        self.assertEqual(loader.call_count, 1)
+        with patch('edx_shopify.cache.time.time', return_value=1061):
+            self.cache.get('key', loader)
+        self.assertEqual(loader.call_count, 2)
+
+    def test_loader_error_not_cached(self):
+        loader = Mock(side_effect=KeyError('key'))
+
+        with self.assertRaises(KeyError):
+            self.cache.get('key', loader)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_invalidate_and_clear(self):
+        loader = Mock(return_value='value')
+
+        self.cache.get('key', loader)
+        self.cache.invalidate('key')
+        self.cache.get('key', loader)
+        self.assertEqual(loader.call_count, 2)
+
+        self.cache.clear()
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 0, 'misses': 0, 'hit_rate': 0.0,
+                          'size': 0, 'maxsize': 2})
+
+    def test_get_and_set(self):
+        # Without a loader, a miss returns None and caches nothing
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+        self.cache.set('key', 'value')
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_invalidate_if(self):
+        loader = Mock(side_effect=lambda key: key)
+
+        self.cache.get(('course1', 'site1'), loader)
+        self.cache.get(('course2', 'site1'), loader)
+        self.cache.invalidate_if(lambda key: key[0] == 'course1')
+        self.assertEqual(self.cache.stats()['size'], 1)
+        self.cache.get(('course2', 'site1'), loader)
+        self.assertEqual(loader.call_count, 2)
+
+    def test_hit_rate(self):
+        loader = Mock(return_value='value')
+        for i in range(4):
+            self.cache.get('key', loader)
+        self.assertEqual(self.cache.stats()['hit_rate'], 0.75)
+
+
+class CourseCacheInvalidationTest(TestCase):
+
+    def setUp(self):
+        course_cache.clear()
+        email_params_cache.clear()
+
+    def test_course_published(self):
+        loader = Mock(return_value='course')
+
+        course_cache.get('course-key', loader)
+        invalidate_course_cache(sender=None, course_key='course-key')
+        course_cache.get('course-key', loader)
+
+        self.assertEqual(loader.call_count, 2)
+
+    def test_email_params_invalidation(self):
+        loader = Mock(return_value={})
+
+        email_params_cache.get(('course-key', 'site1'), loader)
+        email_params_cache.get(('course-key', 'site2'), loader)
+        email_params_cache.get(('other-course-key', 'site1'), loader)
+
+        # Publishing a course drops its email parameters for all sites
+        invalidate_course_cache(sender=None, course_key='course-key')
+        self.assertEqual(email_params_cache.stats()['size'], 1)
+
+        # Changing a site configuration drops them all
+        invalidate_email_params_cache(sender=None)
+        self.assertEqual(email_params_cache.stats()['size'], 0)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from edx_shopify.dedupe import select_duplicates, deduplicate_order_items
+from edx_shopify.models import Order, OrderItem
+
+
+class SelectDuplicatesTest(TestCase):
+
+    def test_keep_processed(self):
+        rows = [(3, OrderItem.UNPROCESSED),
+                (5, OrderItem.PROCESSED),
+                (7, OrderItem.ERROR)]
+        self.assertEqual(select_duplicates(rows), [3, 7])
+
+    def test_keep_oldest(self):
+        rows = [(8, OrderItem.ERROR),
+                (4, OrderItem.UNPROCESSED),
+                (6, OrderItem.UNPROCESSED)]
+        self.assertEqual(select_duplicates(rows), [8, 6])
+
+
+class DeduplicateOrderItemsTest(TestCase):
+
+    def setUp(self):
+        order = Order.objects.create(id=60,
+                                     email='janedoe@example.com',
+                                     first_name='Jane',
+                                     last_name='Doe')
+        OrderItem.objects.create(order=order,
+                                 sku='course-v1:org+course+run1',
+                                 email='learner@example.com')
+
+    def test_no_duplicates(self):
+        # With the unique constraint in place there is nothing to
+        # remove, and nothing must be removed
+        self.assertEqual(deduplicate_order_items(), 0)
+        self.assertEqual(OrderItem.objects.count(), 1)
+
+    def test_command_dry_run(self):
+        out = StringIO()
+        call_command('dedupe_order_items', dry_run=True, stdout=out)
+        self.assertIn('Found 0 duplicate order item(s)', out.getvalue())
+        self.assertEqual(OrderItem.objects.count(), 1)
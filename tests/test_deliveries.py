@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from django.test import override_settings
+
+from edx_shopify import metrics, tasks, views
+from edx_shopify.deliveries import (delivered_cache, is_redelivery,
+                                    mark_delivered)
+from edx_shopify.models import Order
+
+from . import ShopifyTestCase
+from .test_metrics import memory_metrics_settings
+from .test_views import sign
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class RedeliveryTest(ShopifyTestCase):
+
+    def setUp(self):
+        delivered_cache.clear()
+        cache.clear()
+        self.addCleanup(delivered_cache.clear)
+        self.addCleanup(cache.clear)
+
+        override = memory_metrics_settings()
+        override.enable()
+        self.addCleanup(override.disable)
+        self.backend = metrics.get_backend()
+
+    def test_local_cache(self):
+        self.assertFalse(is_redelivery('webhook-1'))
+        mark_delivered('webhook-1')
+        self.assertTrue(is_redelivery('webhook-1'))
+        self.assertFalse(is_redelivery('webhook-2'))
+        self.assertEqual(
+            self.backend.counters['webhook.duplicate.local'], 1)
+
+    def test_shared_cache(self):
+        # A webhook delivered to another process is found in the
+        # shared cache, and then remembered locally
+        mark_delivered('webhook-1')
+        delivered_cache.clear()
+
+        self.assertTrue(is_redelivery('webhook-1'))
+        self.assertTrue(is_redelivery('webhook-1'))
+        self.assertEqual(
+            self.backend.counters['webhook.duplicate.shared'], 1)
+        self.assertEqual(
+            self.backend.counters['webhook.duplicate.local'], 1)
+
+    def test_expiry(self):
+        with override_settings(WEBHOOK_SETTINGS={'edx_shopify': {
+                'webhook_id_ttl': -1}}):
+            mark_delivered('webhook-1')
+        delivered_cache.clear()
+        self.assertFalse(is_redelivery('webhook-1'))
+
+    def test_order_create(self):
+        self.setup_payload()
+        headers = {
+            'HTTP_X_SHOPIFY_HMAC_SHA256': sign(self.raw_payload),
+            'HTTP_X_SHOPIFY_SHOP_DOMAIN': 'example.com',
+            'HTTP_X_SHOPIFY_WEBHOOK_ID': 'b54557e4-bdd9-4b37',
+        }
+
+        # Run on-commit callbacks right away, as the test case never
+        # commits
+        with patch.object(views.transaction, 'on_commit',
+                          side_effect=lambda func: func()), \
+                patch.object(tasks.process, 'delay') as mock_delay, \
+                patch.object(views, 'parse_order',
+                             wraps=views.parse_order) as mock_parse_order:
+            for i in range(3):
+                response = self.client.post('/shopify/order/create',
+                                            self.raw_payload,
+                                            content_type='application/json',
+                                            **headers)
+                self.assertEqual(response.status_code, 200)
+
+        # Only the first delivery was parsed, recorded and queued
+        self.assertEqual(mock_parse_order.call_count, 1)
+        self.assertEqual(mock_delay.call_count, 1)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(
+            self.backend.counters['webhook.duplicate.local'], 2)
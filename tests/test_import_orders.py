@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.db.models import Count
+from django.utils.dateparse import parse_datetime
+from django.utils.six import StringIO
+
+from edx_shopify import tasks
+from edx_shopify.models import Order, OrderItem
+from edx_shopify.utils import bulk_record_orders, record_order
+
+from . import ShopifyTestCase
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class BulkRecordOrdersTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+
+    def test_bulk_record(self):
+        records = [self.order_data._replace(id=order_id)
+                   for order_id in (80, 81, 81)]
+
+        # One query to find existing orders, and one insert each for
+        # orders and order items, in a savepoint
+        with self.assertNumQueries(5):
+            new = bulk_record_orders(records)
+
+        self.assertEqual([data.id for data in new], [80, 81])
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(OrderItem.objects.filter(order_id=81).count(), 2)
+
+        order = Order.objects.get(id=80)
+        self.assertEqual(order.status, Order.UNPROCESSED)
+        self.assertEqual(order.data, self.order_data._replace(id=80))
+
+    def test_skip_existing(self):
+        record_order(self.order_data._replace(id=80))
+        records = [self.order_data._replace(id=order_id)
+                   for order_id in (80, 81)]
+        new = bulk_record_orders(records)
+        self.assertEqual([data.id for data in new], [81])
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_race(self):
+        # A webhook records order 81 after we looked for existing
+        # orders: the batch falls back to recording orders one by one
+        record_order(self.order_data._replace(id=81))
+        records = [self.order_data._replace(id=order_id)
+                   for order_id in (80, 81, 82)]
+        with patch.object(Order.objects, 'filter',
+                          return_value=Order.objects.none()):
+            new = bulk_record_orders(records)
+
+        self.assertEqual([data.id for data in new], [80, 82])
+        self.assertEqual(Order.objects.count(), 3)
+        # The order recorded by the webhook is left alone
+        self.assertEqual(
+            dict(Order.objects.values_list('id').annotate(
+                items=Count('orderitem'))),
+            {80: 2, 81: 0, 82: 2})
+
+
+class ImportOrdersTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write_file(self, lines):
+        path = os.path.join(self.tmpdir, 'orders.jsonl')
+        with open(path, 'w') as f:
+            for line in lines:
+                f.write(line + '\n')
+        return path
+
+    def make_line(self, order_id):
+        payload = dict(self.json_payload, id=order_id)
+        return json.dumps(payload)
+
+    def import_orders(self, *args):
+        out = StringIO()
+        err = StringIO()
+        call_command('import_orders', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_import(self):
+        path = self.write_file([self.make_line(order_id)
+                                for order_id in range(90, 95)])
+        out, err = self.import_orders(path, '--batch-size=2')
+
+        self.assertEqual(Order.objects.count(), 5)
+        self.assertEqual(OrderItem.objects.count(), 10)
+        self.assertIn('read 5 record(s), imported 5', out)
+        self.assertEqual(err, '')
+
+        # Imported orders were received when they were placed
+        self.assertEqual(Order.objects.get(id=90).received,
+                         parse_datetime(self.json_payload['created_at']))
+
+    def test_skip_existing_and_invalid(self):
+        record_order(self.order_data._replace(id=90))
+        path = self.write_file([self.make_line(90),
+                                '',
+                                '{"id": 91',
+                                self.make_line(92)])
+        out, err = self.import_orders(path)
+
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertIn('read 3 record(s), imported 1, '
+                      'skipped 1 existing, 1 invalid', out)
+        self.assertIn('Line 3:', err)
+
+    def test_process(self):
+        path = self.write_file([self.make_line(90)])
+        with patch.object(tasks.process, 'delay') as mock_delay:
+            self.import_orders(path, '--process', '--no-email')
+        self.assertEqual(mock_delay.call_count, 1)
+        message, send_email = mock_delay.call_args[0]
+        self.assertEqual(message['id'], 90)
+        self.assertFalse(send_email)
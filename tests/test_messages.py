@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.test import TestCase
+
+from edx_shopify.messages import pack_order, unpack_order
+
+from . import ShopifyTestCase
+
+
+class MessageTest(TestCase):
+
+    def test_round_trip(self):
+        line_items = [('course-v1:org+course+run1', 'learner@example.com'),
+                      ('course-v1:org+course+run2', 'learner@example.com')]
+        message = pack_order(42, line_items)
+        self.assertIn('items', message)
+        self.assertEqual(unpack_order(message), (42, line_items))
+
+    def test_order_id_only(self):
+        self.assertEqual(unpack_order(pack_order(42)), (42, None))
+        self.assertEqual(unpack_order(42), (42, None))
+
+    def test_compressed_round_trip(self):
+        line_items = [('course-v1:org+course+run1',
+                       'learner%d@example.com' % i) for i in range(200)]
+        message = pack_order(42, line_items)
+        self.assertIn('zitems', message)
+        self.assertLess(len(json.dumps(message)),
+                        len(json.dumps(line_items)))
+        self.assertEqual(unpack_order(message), (42, line_items))
+
+
+class LegacyMessageTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+
+    def test_full_payload(self):
+        # Tasks queued by earlier versions carry the full payload
+        self.assertEqual(
+            unpack_order(self.json_payload),
+            (self.json_payload['id'],
+             [('course-v1:org+course+run1', 'learner@example.com'),
+              ('course-v1:org+course+run2', 'learner@example.com')]))
+
+    def test_message_size(self):
+        message = pack_order(*unpack_order(self.json_payload))
+        self.assertLess(len(json.dumps(message)),
+                        len(json.dumps(self.json_payload)) / 10)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import base64
+import hmac
+import socket
+
+from django.conf import settings
+from django.test import Client
+
+from edx_shopify import metrics, tasks, utils
+from edx_shopify.utils import process_order, record_order
+
+from . import ShopifyTestCase, shopify_settings
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+
+def memory_metrics_settings():
+    "Return settings that use the in-memory metrics backend."
+    return shopify_settings(
+        metrics_backend='edx_shopify.metrics.MemoryMetrics')
+
+
+class BackendTest(ShopifyTestCase):
+
+    def test_null_backend(self):
+        backend = metrics.get_backend()
+        self.assertIsInstance(backend, metrics.NullMetrics)
+        self.assertIs(metrics.timer('foo'), metrics.NULL_TIMER)
+        metrics.incr('foo')
+        metrics.timing('foo', 1)
+
+    def test_memory_backend(self):
+        with memory_metrics_settings():
+            backend = metrics.get_backend()
+            self.assertIsInstance(backend, metrics.MemoryMetrics)
+
+            metrics.incr('foo')
+            metrics.incr('foo', 2)
+            with metrics.timer('bar'):
+                pass
+            with self.assertRaises(ValueError):
+                with metrics.timer('bar'):
+                    raise ValueError
+            self.assertEqual(backend.counters['foo'], 3)
+            self.assertEqual(len(backend.timings['bar']), 2)
+
+        # Once the settings are restored, so is the default backend
+        self.assertIsInstance(metrics.get_backend(), metrics.NullMetrics)
+
+    def test_statsd_backend(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+
+        backend = metrics.StatsdMetrics(port=server.getsockname()[1],
+                                        host='127.0.0.1')
+        backend.incr('webhook.status.200')
+        self.assertEqual(server.recv(512),
+                         b'edx_shopify.webhook.status.200:1|c')
+        backend.timing('webhook', 0.25)
+        self.assertEqual(server.recv(512), b'edx_shopify.webhook:250.000|ms')
+
+
+class InstrumentationTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_course()
+        override = memory_metrics_settings()
+        override.enable()
+        self.addCleanup(override.disable)
+        self.backend = metrics.get_backend()
+
+    def test_process_order(self):
+        order, created = record_order(self.order_data)
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            get_email_params=Mock(
+                                return_value=self.email_params),
+                            enroll_email=Mock(),
+                            send_mail_to_student=Mock()):
+            process_order(order, self.order_data.line_items,
+                          send_email=True)
+
+        self.assertEqual(self.backend.counters['order.processed'], 1)
+        self.assertEqual(self.backend.counters['enroll.enrolled'], 2)
+        self.assertEqual(self.backend.counters['email.sent'], 2)
+        self.assertEqual(len(self.backend.timings['order.process']), 1)
+        self.assertEqual(len(self.backend.timings['enroll.course_load']), 2)
+        self.assertEqual(len(self.backend.timings['enroll.enroll_email']),
+                         2)
+        self.assertEqual(len(self.backend.timings['email.send']), 2)
+
+    def test_order_create(self):
+        conf = settings.WEBHOOK_SETTINGS['edx_shopify']
+        signature = base64.b64encode(hmac.new(conf['api_key'],
+                                              self.raw_payload,
+                                              hashlib.sha256).digest())
+        with patch.object(tasks.process, 'delay'):
+            response = Client().post('/shopify/order/create',
+                                     self.raw_payload,
+                                     content_type='application/json',
+                                     HTTP_X_SHOPIFY_HMAC_SHA256=signature,
+                                     HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.backend.counters['webhook.status.200'], 1)
+        for stage in ('webhook', 'webhook.verify', 'webhook.parse',
+                      'webhook.record', 'webhook.publish'):
+            self.assertEqual(len(self.backend.timings[stage]), 1, stage)
@@ -1,12 +1,11 @@
 # -*- coding: utf-8 -*-
 import datetime
-import warnings
 
 from django.test import TestCase
-from django.db import connection
-from django.db import DatabaseError, IntegrityError
+from django.db import IntegrityError, transaction
 
 from edx_shopify.models import Order, OrderItem
+from edx_shopify.payload import OrderData, LineItem, encode_order
 
 
 class TestOrder(TestCase):
@@ -34,6 +33,19 @@ class TestOrder(TestCase):
         # Can we save the order?
         self.order.save()
 
+    def test_data(self):
+        # Is the stored payload decoded from the database?
+        self.assertIsNone(self.order.data)
+        data = OrderData(id=1,
+                         email='johndoe@example.com',
+                         first_name='John',
+                         last_name='Doe',
+                         line_items=[LineItem('course-v1:org+course+run1',
+                                              'learner@example.com')])
+        self.order.payload = encode_order(data)
+        self.order.save()
+        self.assertEqual(self.model.objects.get(id=1).data, data)
+
 
 class TestOrderItem(TestCase):
 
@@ -95,16 +107,11 @@ class TestOrderItem(TestCase):
     def test_same_order_same_email_same_sku(self):
         # Do we fail to create an order item with the same order
         # reference, SKU, and email?
-        #
-        # Note: the unique_together constraint is enforced at the
-        # database level. The sqlite3 backend does not support it.
+        self.order_item.save()
         second_order_item = self.model()
         second_order_item.order = self.order_item.order
         second_order_item.sku = self.order_item.sku
         second_order_item.email = self.order_item.email
-        if connection.vendor in ['sqlite']:
-            warnings.warn("Unable to test for unique_together "
-                          "constraint enforcement with %s" % connection.vendor)
-        else:
-            with self.assertRaises(DatabaseError):
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
                 second_order_item.save()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import json
+
+from edx_shopify.payload import OrderData, LineItem, PayloadError
+from edx_shopify.payload import parse_order, load_order
+from edx_shopify.payload import encode_order, decode_order
+
+from . import ShopifyTestCase
+
+
+class ParseOrderTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+
+    def test_parse_order(self):
+        data = parse_order(self.raw_payload)
+        self.assertIsInstance(data, OrderData)
+        self.assertEqual(data.id, self.json_payload['id'])
+        self.assertEqual(data.email, 'buyer@example.com')
+        self.assertEqual(data.first_name, 'Buyer')
+        self.assertEqual(data.last_name, 'Name')
+        self.assertEqual(data.line_items,
+                         [LineItem('course-v1:org+course+run1',
+                                   'learner@example.com'),
+                          LineItem('course-v1:org+course+run2',
+                                   'learner@example.com')])
+
+    def test_invalid_json(self):
+        with self.assertRaises(PayloadError):
+            parse_order(self.raw_payload[:-10])
+
+    def test_missing_fields(self):
+        for key in ['id', 'customer', 'line_items']:
+            data = dict(self.json_payload)
+            del data[key]
+            with self.assertRaises(PayloadError):
+                load_order(data)
+
+    def test_invalid_line_items(self):
+        invalid_line_items = [
+            # No SKU
+            [{"properties": [{"name": "email",
+                              "value": "learner@example.com"}]}],
+            # No properties
+            [{"sku": "course-v1:org+course+run1"}],
+            # No email property
+            [{"properties": [{"name": "name", "value": "Learner"}],
+              "sku": "course-v1:org+course+run1"}],
+            # Email is not a string
+            [{"properties": [{"name": "email", "value": 42}],
+              "sku": "course-v1:org+course+run1"}],
+            # Not a list of line items
+            "course-v1:org+course+run1",
+        ]
+        for line_items in invalid_line_items:
+            data = dict(self.json_payload, line_items=line_items)
+            with self.assertRaises(PayloadError):
+                parse_order(json.dumps(data))
+
+    def test_missing_names(self):
+        customer = dict(self.json_payload['customer'],
+                        first_name=None)
+        del customer['last_name']
+        data = load_order(dict(self.json_payload, customer=customer))
+        self.assertEqual(data.first_name, '')
+        self.assertEqual(data.last_name, '')
+
+
+class StoredOrderTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+
+    def test_round_trip(self):
+        encoded = encode_order(self.order_data)
+        self.assertLess(len(encoded), len(self.raw_payload) / 10)
+        self.assertEqual(decode_order(encoded), self.order_data)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.test import Client
+from django.utils import timezone
+
+from edx_shopify import metrics
+from edx_shopify.models import Order
+from edx_shopify.prometheus import render_metrics
+from edx_shopify.utils import record_order
+
+from . import ShopifyTestCase, shopify_settings
+
+
+class OrderMetricsTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        override = shopify_settings(metrics_token='sekrit')
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def make_order(self, order_id, status, age=0, claimed_age=None):
+        order, created = record_order(self.order_data._replace(id=order_id))
+        order.status = status
+        order.received = timezone.now() - timedelta(seconds=age)
+        if claimed_age is not None:
+            order.claimed = timezone.now() - timedelta(seconds=claimed_age)
+        order.save()
+        return order
+
+    def scrape(self, **headers):
+        headers.setdefault('HTTP_AUTHORIZATION', 'Bearer sekrit')
+        response = Client().get('/shopify/metrics', **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        return response.content.decode('utf-8').splitlines()
+
+    def test_order_counts(self):
+        self.make_order(1, Order.UNPROCESSED, age=600)
+        self.make_order(2, Order.UNPROCESSED, age=60)
+        # An old order that was claimed just now is not stuck, but
+        # one that was never claimed goes by when it was received
+        self.make_order(3, Order.PROCESSING, age=3600, claimed_age=0)
+        self.make_order(4, Order.PROCESSED)
+        self.make_order(5, Order.ERROR)
+
+        # One indexed query per status, plus one per oldest order
+        with self.assertNumQueries(6):
+            lines = render_metrics().splitlines()
+
+        self.assertIn('edx_shopify_orders{status="unprocessed"} 2', lines)
+        self.assertIn('edx_shopify_orders{status="processing"} 1', lines)
+        self.assertIn('edx_shopify_orders{status="processed"} 1', lines)
+        self.assertIn('edx_shopify_orders{status="error"} 1', lines)
+
+        ages = dict(line.rsplit(' ', 1) for line in lines
+                    if line.startswith('edx_shopify_oldest_order_age'))
+        self.assertGreaterEqual(
+            float(ages['edx_shopify_oldest_order_age_seconds'
+                       '{status="unprocessed"}']),
+            600)
+        self.assertLess(
+            float(ages['edx_shopify_oldest_order_age_seconds'
+                       '{status="processing"}']),
+            60)
+
+        self.make_order(6, Order.PROCESSING, age=300)
+        lines = render_metrics().splitlines()
+        ages = dict(line.rsplit(' ', 1) for line in lines
+                    if line.startswith('edx_shopify_oldest_order_age'))
+        self.assertGreaterEqual(
+            float(ages['edx_shopify_oldest_order_age_seconds'
+                       '{status="processing"}']),
+            300)
+
+    def test_cached_processed_count(self):
+        self.make_order(1, Order.PROCESSED)
+        self.scrape()
+
+        # The processed count comes from the cache, skipping one
+        # query, until it expires
+        self.make_order(2, Order.PROCESSED)
+        with self.assertNumQueries(5):
+            lines = render_metrics().splitlines()
+        self.assertIn('edx_shopify_orders{status="processed"} 1', lines)
+
+        cache.clear()
+        lines = self.scrape()
+        self.assertIn('edx_shopify_orders{status="processed"} 2', lines)
+
+    def test_histograms(self):
+        # The default backend keeps no histograms
+        lines = self.scrape()
+        self.assertFalse([line for line in lines
+                          if line.startswith('edx_shopify_webhook_seconds')])
+
+        with shopify_settings(
+                metrics_backend='edx_shopify.metrics.MemoryMetrics'):
+            metrics.timing('webhook', 0.02)
+            metrics.timing('webhook', 3)
+            lines = self.scrape()
+
+        self.assertIn('# TYPE edx_shopify_webhook_seconds histogram', lines)
+        self.assertIn('edx_shopify_webhook_seconds_bucket{le="0.01"} 0',
+                      lines)
+        self.assertIn('edx_shopify_webhook_seconds_bucket{le="0.025"} 1',
+                      lines)
+        self.assertIn('edx_shopify_webhook_seconds_bucket{le="+Inf"} 2',
+                      lines)
+        self.assertIn('edx_shopify_webhook_seconds_count 2', lines)
+        self.assertIn('edx_shopify_order_process_seconds_count 0', lines)
+
+    def test_counters(self):
+        with shopify_settings(
+                metrics_backend='edx_shopify.metrics.MemoryMetrics'):
+            metrics.incr('webhook.duplicate.local')
+            lines = self.scrape()
+        self.assertIn('edx_shopify_webhook_duplicate_local_total 1', lines)
+        self.assertIn('edx_shopify_webhook_duplicate_shared_total 0', lines)
+
+    def test_token(self):
+        response = Client().get('/shopify/metrics')
+        self.assertEqual(response.status_code, 403)
+        response = Client().get('/shopify/metrics',
+                                HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 403)
+        self.scrape(HTTP_AUTHORIZATION='Bearer sekrit')
+
+    def test_no_token(self):
+        # Without a metrics_token, the endpoint is disabled
+        with shopify_settings(metrics_token=None):
+            response = Client().get('/shopify/metrics',
+                                    HTTP_AUTHORIZATION='Bearer None')
+        self.assertEqual(response.status_code, 404)
+
+
+class CacheMetricsTest(ShopifyTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_cache_metrics(self):
+        backend = metrics.CacheMetrics()
+        backend.incr('foo')
+        backend.incr('foo', 2)
+        self.assertEqual(cache.get('edx_shopify:metrics:counter:foo'), 3)
+
+        backend.timing('bar', 0.001)
+        backend.timing('bar', 0.3)
+        backend.timing('bar', 20)
+
+        # Another backend instance (in another process) shares the
+        # same histogram
+        buckets, total, count = metrics.CacheMetrics().get_histogram('bar')
+        self.assertEqual(count, 3)
+        self.assertAlmostEqual(total, 20.301)
+        self.assertEqual(buckets[0], (0.005, 1))
+        self.assertEqual(dict(buckets)[0.5], 2)
+        self.assertEqual(buckets[-1], (float('inf'), 3))
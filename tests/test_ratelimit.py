@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from django.test import TestCase
+
+from edx_shopify import ratelimit
+from edx_shopify.ratelimit import RateLimiter
+from edx_shopify.tasks import get_email_bucket
+
+from . import shopify_settings
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class RateLimiterTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_shared_limit(self):
+        # Two limiters, as in two worker processes, share one count
+        first = RateLimiter(1, capacity=3)
+        second = RateLimiter(1, capacity=3)
+        with patch.object(ratelimit.time, 'time', return_value=30.5):
+            self.assertTrue(first.can_consume(1))
+            self.assertTrue(second.can_consume(1))
+            self.assertTrue(first.can_consume(1))
+            self.assertFalse(second.can_consume(1))
+            self.assertFalse(first.can_consume(1))
+
+            # The next window starts at 33 seconds
+            self.assertAlmostEqual(first.expected_time(1), 2.5)
+            self.assertAlmostEqual(first.expected_time(4), 5.5)
+
+        with patch.object(ratelimit.time, 'time', return_value=33.0):
+            self.assertTrue(first.can_consume(1))
+
+    def test_default_capacity(self):
+        limiter = RateLimiter(0.5)
+        self.assertEqual(limiter.capacity, 1)
+        self.assertEqual(limiter.period, 2)
+
+    def test_slow_rate(self):
+        # Less than one email per second, with no burst configured,
+        # still lets one email through per window
+        with shopify_settings(email_rate=0.5):
+            limiter = get_email_bucket()
+        self.assertEqual(limiter.capacity, 1)
+        with patch.object(ratelimit.time, 'time', return_value=10.0):
+            self.assertTrue(limiter.can_consume(1))
+            self.assertFalse(limiter.can_consume(1))
+            self.assertAlmostEqual(limiter.expected_time(1), 2.0)
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            RateLimiter(0)
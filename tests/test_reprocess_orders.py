@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from edx_shopify import tasks, utils
+from edx_shopify.management.commands import reprocess_orders
+from edx_shopify.models import Order, OrderItem
+from edx_shopify.utils import record_order, reset_order
+
+from . import ShopifyTestCase
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+
+class ReprocessOrdersTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_course()
+
+    def make_order(self, order_id, status, received=None, claimed=None):
+        order, created = record_order(self.order_data._replace(id=order_id))
+        order.status = status
+        if received:
+            order.received = received
+        order.claimed = claimed
+        order.save()
+        OrderItem.objects.create(order=order,
+                                 sku='course-v1:org+course+run1',
+                                 email='learner@example.com',
+                                 status=OrderItem.PROCESSED)
+        OrderItem.objects.create(order=order,
+                                 sku='course-v1:org+course+run2',
+                                 email='learner@example.com',
+                                 status=OrderItem.ERROR)
+        return order
+
+    def reprocess(self, *args, **kwargs):
+        out = StringIO()
+        self.mock_enroll_email = Mock()
+        if kwargs.get('inline', True):
+            args = ('--inline', '--workers=1') + args
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            enroll_email=self.mock_enroll_email):
+            call_command('reprocess_orders', '--no-email',
+                         *args, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_reset_order(self):
+        order = self.make_order(70, Order.ERROR)
+
+        # The order is not PROCESSING, so it must not be reset
+        self.assertIsNone(reset_order(order.id, Order.PROCESSING))
+
+        self.assertEqual(reset_order(order.id, Order.ERROR),
+                         [('course-v1:org+course+run2',
+                           'learner@example.com')])
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.UNPROCESSED)
+        self.assertFalse(OrderItem.objects.filter(
+            order=order, status=OrderItem.ERROR).exists())
+
+    def test_reprocess_error(self):
+        order = self.make_order(71, Order.ERROR)
+
+        out = self.reprocess('--status', 'error')
+
+        self.assertIn('reprocessed 1 order(s), skipped 0', out)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.PROCESSED)
+        # Only the failed line item was enrolled again
+        self.assertEqual(self.mock_enroll_email.call_count, 1)
+        self.assertFalse(OrderItem.objects.filter(order=order).exclude(
+            status=OrderItem.PROCESSED).exists())
+
+    def test_reprocess_stuck(self):
+        two_hours_ago = timezone.now() - timedelta(hours=2)
+        stuck = self.make_order(72, Order.PROCESSING,
+                                two_hours_ago, two_hours_ago)
+        recent = self.make_order(73, Order.PROCESSING,
+                                 claimed=timezone.now())
+        # An old order that was claimed again just now, say by an
+        # earlier run of the command, is not stuck
+        reclaimed = self.make_order(74, Order.PROCESSING,
+                                    two_hours_ago, timezone.now())
+        # Orders claimed before claims were timestamped go by when
+        # they were received
+        unclaimed = self.make_order(75, Order.PROCESSING, two_hours_ago)
+
+        self.reprocess('--status', 'processing', '--stuck-after', '60')
+
+        for order in (stuck, recent, reclaimed, unclaimed):
+            order.refresh_from_db()
+        self.assertEqual(stuck.status, Order.PROCESSED)
+        self.assertEqual(recent.status, Order.PROCESSING)
+        self.assertEqual(reclaimed.status, Order.PROCESSING)
+        self.assertEqual(unclaimed.status, Order.PROCESSED)
+
+    def test_stored_payload(self):
+        # Without OrderItems, the line items come from the payload
+        # stored with the order
+        order, created = record_order(self.order_data._replace(id=76))
+        Order.objects.filter(id=order.id).update(status=Order.ERROR)
+
+        self.reprocess()
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.PROCESSED)
+        self.assertEqual(self.mock_enroll_email.call_count, 2)
+
+    def test_no_line_items(self):
+        # Without OrderItems or a stored payload, we don't know what
+        # to enroll
+        order, created = record_order(self.order_data._replace(id=74))
+        Order.objects.filter(id=order.id).update(status=Order.ERROR,
+                                                 payload=None)
+
+        out = self.reprocess()
+
+        self.assertIn('reprocessed 0 order(s), skipped 1', out)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.ERROR)
+
+    def test_queued(self):
+        # Without --inline, orders are reset and queued a chunk at a
+        # time (the tasks run eagerly in the tests)
+        failed = [self.make_order(order_id, Order.ERROR)
+                  for order_id in (80, 81, 82)]
+        record_order(self.order_data._replace(id=83))
+        Order.objects.filter(id=83).update(status=Order.ERROR,
+                                           payload=None)
+
+        with patch.object(reprocess_orders, 'requeue_orders',
+                          wraps=tasks.requeue_orders) as mock_requeue:
+            out = self.reprocess('--chunk-size=2', inline=False)
+
+        self.assertIn('reprocessed 3 order(s), skipped 1', out)
+        self.assertEqual(mock_requeue.call_count, 2)
+        for order in failed:
+            order.refresh_from_db()
+            self.assertEqual(order.status, Order.PROCESSED)
+
+    def test_dry_run(self):
+        order = self.make_order(75, Order.ERROR)
+
+        out = self.reprocess('--dry-run')
+
+        self.assertIn('Order 75 (Error)', out)
+        self.assertIn('Found 1 order(s) to reprocess', out)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.ERROR)
@@ -1,13 +1,32 @@
 # -*- coding: utf-8 -*-
 import json
+import random
+import time
 
+from multiprocessing.pool import ThreadPool
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connections, OperationalError
 from django.http import Http404
+from student.models import UserProfile
 
-from edx_shopify.models import Order
-from edx_shopify.tasks import process
+from edx_shopify import tasks, utils
+from edx_shopify.messages import pack_order, unpack_order
+from edx_shopify.models import Order, OrderItem
+from edx_shopify.payload import LineItem, load_order
+from edx_shopify.ratelimit import RateLimiter
+from edx_shopify.tasks import process, notify_enrollments
+from edx_shopify.tasks import queue_enrollment_emails, get_retry_countdown
 from edx_shopify.utils import record_order
 
-from . import ShopifyTestCase
+from . import ShopifyTestCase, shopify_settings
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
 
 
 class ProcessOrderTest(ShopifyTestCase):
@@ -19,7 +38,7 @@ class ProcessOrderTest(ShopifyTestCase):
         fixup_payload = self.raw_payload.replace("course-v1:org+course+run1",
                                                  "course-v1:org+nosuchcourse+run1")  # noqa: E501
         fixup_json_payload = json.loads(fixup_payload)
-        order, created = record_order(fixup_json_payload)
+        order, created = record_order(load_order(fixup_json_payload))
 
         result = None
         with self.assertRaises(Http404):
@@ -34,3 +53,424 @@ class ProcessOrderTest(ShopifyTestCase):
         # learn of the update until we refresh from the database.
         order.refresh_from_db()
         self.assertEqual(order.status, Order.ERROR)
+
+    def test_malformed_legacy_payload(self):
+        # A full payload queued by an earlier version, with a line
+        # item lacking its email property, must still end up in the
+        # ERROR state
+        order, created = record_order(self.order_data)
+        payload = json.loads(self.raw_payload)
+        payload['line_items'][0]['properties'] = []
+
+        result = None
+        with self.assertRaises(KeyError):
+            result = process.delay(payload)
+            result.get(5)
+
+        self.assertEqual(result.state, 'FAILURE')
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.ERROR)
+
+    def test_stored_payload(self):
+        # Given only the order ID, the task must process the line
+        # items stored with the order
+        self.setup_course()
+        order, created = record_order(self.order_data)
+        mock_enroll_email = Mock()
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            enroll_email=mock_enroll_email):
+            result = process.delay(order.id)
+
+        self.assertEqual(result.state, 'SUCCESS')
+        self.assertEqual(mock_enroll_email.call_count, 2)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.PROCESSED)
+
+    def test_invalid_sku_compact_message(self):
+        fixup_payload = self.raw_payload.replace("course-v1:org+course+run1",
+                                                 "course-v1:org+nosuchcourse+run1")  # noqa: E501
+        fixup_json_payload = json.loads(fixup_payload)
+        order, created = record_order(load_order(fixup_json_payload))
+        message = pack_order(*unpack_order(fixup_json_payload))
+
+        result = None
+        with self.assertRaises(Http404):
+            result = process.delay(message)
+            result.get(5)
+
+        self.assertEqual(result.state, 'FAILURE')
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.ERROR)
+
+
+class RetryTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_course()
+        self.order, created = record_order(self.order_data)
+        self.message = pack_order(self.order.id,
+                                  self.order_data.line_items)
+
+    def test_transient_error(self):
+        # The second course fails to load once. The retry must only
+        # re-attempt the line item for that course.
+        failures = [OperationalError('Deadlock found')]
+
+        def get_course_by_id(course_key):
+            if course_key.run == 'run2' and failures:
+                raise failures.pop()
+            return self.course
+
+        mock_get_course_by_id = Mock(side_effect=get_course_by_id)
+        mock_enroll_email = Mock()
+        with patch.multiple(utils,
+                            get_course_by_id=mock_get_course_by_id,
+                            enroll_email=mock_enroll_email):
+            process.apply(args=(self.message,))
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.PROCESSED)
+        self.assertEqual(mock_get_course_by_id.call_count, 3)
+        self.assertEqual(
+            [args[0].run for args, kwargs in
+             mock_enroll_email.call_args_list],
+            ['run1', 'run2'])
+
+    def test_time_limit(self):
+        # The soft time limit expires halfway through the second batch
+        # of a course. The retry must keep the first batch, and resume
+        # with the second.
+        data = dict(self.json_payload)
+        data['line_items'] = [
+            {"properties": [{"name": "email",
+                             "value": "learner%d@example.com" % i}],
+             "sku": "course-v1:org+course+run1"}
+            for i in range(5)
+        ]
+        order, created = record_order(load_order(data))
+        message = pack_order(order.id, load_order(data).line_items)
+
+        mock_enroll_email = Mock(side_effect=[None, None, None,
+                                              SoftTimeLimitExceeded(),
+                                              None, None, None])
+        with shopify_settings(enrollment_batch_size=2), \
+                patch.multiple(utils,
+                               get_course_by_id=Mock(
+                                   return_value=self.course),
+                               enroll_email=mock_enroll_email):
+            result = process.apply(args=(message,))
+
+        self.assertEqual(result.state, 'SUCCESS')
+        self.assertEqual(
+            [args[1] for args, kwargs in mock_enroll_email.call_args_list],
+            ['learner0@example.com', 'learner1@example.com',
+             'learner2@example.com', 'learner3@example.com',
+             'learner2@example.com', 'learner3@example.com',
+             'learner4@example.com'])
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.PROCESSED)
+
+    def test_transient_lookup_error(self):
+        # Looking up the order fails once. The retry must process the
+        # order from the original message.
+        get = Order.objects.get
+        failures = [OperationalError('Lost connection')]
+
+        def get_order(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return get(*args, **kwargs)
+
+        mock_enroll_email = Mock()
+        with patch.object(Order.objects, 'get', side_effect=get_order), \
+                patch.multiple(utils,
+                               get_course_by_id=Mock(
+                                   return_value=self.course),
+                               enroll_email=mock_enroll_email):
+            result = process.apply(args=(self.message,))
+
+        self.assertEqual(result.state, 'SUCCESS')
+        self.assertEqual(mock_enroll_email.call_count, 2)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.PROCESSED)
+
+    def test_retry_claimed_elsewhere(self):
+        # While a retry was waiting, the order was reset and claimed
+        # by another task: the retry must leave it alone
+        Order.objects.filter(id=self.order.id).update(
+            status=Order.PROCESSING,
+            claimed_by='another-task')
+        mock_enroll_email = Mock()
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            enroll_email=mock_enroll_email):
+            result = process.apply(args=(self.message,),
+                                   task_id='first-task',
+                                   retries=1)
+
+        self.assertEqual(result.state, 'SUCCESS')
+        self.assertFalse(mock_enroll_email.called)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.PROCESSING)
+        self.assertEqual(self.order.claimed_by, 'another-task')
+
+    def test_retries_exhausted(self):
+        mock_get_course_by_id = Mock(
+            side_effect=OperationalError('Deadlock found'))
+        with patch.multiple(utils,
+                            get_course_by_id=mock_get_course_by_id,
+                            enroll_email=Mock()):
+            result = process.apply(args=(self.message,))
+
+        self.assertEqual(result.state, 'FAILURE')
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.ERROR)
+        # One attempt, plus three retries
+        self.assertEqual(mock_get_course_by_id.call_count, 4)
+
+    def test_permanent_error(self):
+        mock_get_course_by_id = Mock(side_effect=Http404)
+        with patch.multiple(utils,
+                            get_course_by_id=mock_get_course_by_id,
+                            enroll_email=Mock()):
+            result = process.apply(args=(self.message,))
+
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertEqual(mock_get_course_by_id.call_count, 1)
+
+    def test_retry_countdown(self):
+        for retries in range(10):
+            delay = min(2 * 2 ** retries, 300)
+            countdown = get_retry_countdown(retries)
+            self.assertGreaterEqual(countdown, delay / 2.0)
+            self.assertLessEqual(countdown, delay)
+
+
+class RequeueOrdersTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_course()
+        for order_id in (1, 2, 3):
+            record_order(self.order_data._replace(id=order_id))
+
+    def test_requeue_orders(self):
+        # Failed orders are reset and processed again, only for their
+        # line items not processed yet. An order that is no longer in
+        # the given status is left alone.
+        Order.objects.filter(id__in=[1, 2]).update(status=Order.ERROR)
+        Order.objects.filter(id=3).update(status=Order.PROCESSED)
+        OrderItem.objects.filter(order_id=1).update(status=OrderItem.ERROR)
+        OrderItem.objects.filter(
+            order_id=2,
+            sku='course-v1:org+course+run1'
+        ).update(status=OrderItem.PROCESSED)
+
+        mock_enroll_email = Mock()
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            enroll_email=mock_enroll_email):
+            requeued = tasks.requeue_orders([1, 2, 3], Order.ERROR,
+                                            send_email=False)
+
+        self.assertEqual(sorted(requeued), [1, 2])
+        self.assertEqual(
+            dict(Order.objects.values_list('id', 'status')),
+            {1: Order.PROCESSED, 2: Order.PROCESSED, 3: Order.PROCESSED})
+        self.assertFalse(OrderItem.objects.filter(
+            order_id__in=[1, 2]
+        ).exclude(
+            status=OrderItem.PROCESSED
+        ).exists())
+        self.assertEqual(
+            [args[0].run for args, kwargs in
+             mock_enroll_email.call_args_list],
+            ['run1', 'run2', 'run2'])
+
+
+class ConcurrencyTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.line_items = self.order_data.line_items
+        self.order_ids = range(100, 140)
+        for order_id in self.order_ids:
+            record_order(self.order_data._replace(id=order_id))
+
+    def test_parallel_orders(self):
+        # Run many orders through the same task instance from a pool
+        # of threads, as a threaded or gevent worker would. Orders
+        # with odd IDs fail. Every order must end up in its own
+        # correct state, no matter how invocations interleave.
+        def process_order(order, line_items, *args, **kwargs):
+            time.sleep(random.uniform(0, 0.01))
+            if order.id % 2:
+                raise ValueError('Order %s failed' % order.id)
+            Order.objects.filter(id=order.id).update(status=Order.PROCESSED)
+
+        # Share the test's database connection with the worker
+        # threads, so they see the test transaction's data
+        connection = connections['default']
+        connection.allow_thread_sharing = True
+
+        def run(order_id):
+            connections['default'] = connection
+            return process.apply(args=(pack_order(order_id,
+                                                  self.line_items),))
+
+        pool = ThreadPool(8)
+        try:
+            with patch.object(tasks, 'process_order',
+                              side_effect=process_order):
+                results = pool.map(run, self.order_ids)
+        finally:
+            pool.close()
+            pool.join()
+            connection.allow_thread_sharing = False
+
+        for order_id, result in zip(self.order_ids, results):
+            order = Order.objects.get(id=order_id)
+            if order_id % 2:
+                self.assertEqual(result.state, 'FAILURE')
+                self.assertEqual(order.status, Order.ERROR)
+            else:
+                self.assertEqual(result.state, 'SUCCESS')
+                self.assertEqual(order.status, Order.PROCESSED)
+
+
+class FanOutTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_course()
+        run1 = [LineItem('course-v1:org+course+run1',
+                         'learner%d@example.com' % i) for i in range(3)]
+        run2 = [LineItem('course-v1:org+course+run2',
+                         'learner%d@example.com' % i) for i in range(2)]
+        self.line_items = run1 + run2
+        self.order, created = record_order(self.order_data)
+
+    def process(self, get_course_by_id):
+        settings = {'edx_shopify': {'chunk_size': 2}}
+        with self.settings(WEBHOOK_SETTINGS=settings), \
+                patch.multiple(utils,
+                               get_course_by_id=get_course_by_id,
+                               enroll_email=Mock()):
+            result = process.delay(pack_order(self.order.id,
+                                              self.line_items))
+        self.order.refresh_from_db()
+        return result
+
+    def test_fan_out(self):
+        result = self.process(Mock(return_value=self.course))
+
+        self.assertEqual(result.state, 'SUCCESS')
+        self.assertEqual(self.order.status, Order.PROCESSED)
+        self.assertEqual(
+            OrderItem.objects.filter(order=self.order,
+                                     status=OrderItem.PROCESSED).count(),
+            5)
+
+    def test_failed_chunk(self):
+        # Line items for the second course fail, those for the first
+        # course succeed, and the order ends up in an ERROR state
+        def get_course_by_id(course_key):
+            if course_key.run == 'run2':
+                raise Http404
+            return self.course
+
+        self.process(Mock(side_effect=get_course_by_id))
+
+        self.assertEqual(self.order.status, Order.ERROR)
+        statuses = dict(
+            ((item.sku, item.email), item.status)
+            for item in OrderItem.objects.filter(order=self.order)
+        )
+        self.assertEqual(statuses,
+                         dict(((sku, email),
+                               OrderItem.PROCESSED if sku.endswith('run1')
+                               else OrderItem.ERROR)
+                              for sku, email in self.line_items))
+
+
+class NotifyEnrollmentsTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_course()
+        self.emails = ['learner%d@example.com' % i for i in range(3)]
+
+        # A user exists for the first email only
+        user = User.objects.create(username='learner0',
+                                   email=self.emails[0])
+        UserProfile.objects.create(user=user, name='Learner Zero')
+
+        self.mock_send_mail_to_student = Mock()
+        self.patcher = patch.multiple(
+            utils,
+            get_course_by_id=Mock(return_value=self.course),
+            get_email_params=Mock(return_value=self.email_params),
+            send_mail_to_student=self.mock_send_mail_to_student)
+        self.patcher.start()
+        self.addCleanup(self.patcher.stop)
+
+    def test_notify_enrollments(self):
+        result = notify_enrollments.apply(args=(self.course_id_string,
+                                                self.emails))
+        self.assertEqual(result.state, 'SUCCESS')
+
+        calls = self.mock_send_mail_to_student.call_args_list
+        self.assertEqual([c[0][0] for c in calls], self.emails)
+        self.assertEqual([c[0][1]['message_type'] for c in calls],
+                         ['enrolled_enroll',
+                          'allowed_enroll',
+                          'allowed_enroll'])
+        self.assertEqual(calls[0][0][1]['full_name'], 'Learner Zero')
+        self.assertEqual(calls[1][0][1]['email_address'], self.emails[1])
+
+    def test_rate_limit(self):
+        # With only two emails allowed per window, the third one must
+        # be requeued rather than sent
+        cache.clear()
+        self.addCleanup(cache.clear)
+        bucket = RateLimiter(0.01, capacity=2)
+        with patch.object(tasks, 'get_email_bucket',
+                          return_value=bucket), \
+                patch.object(notify_enrollments,
+                             'apply_async') as mock_apply_async:
+            notify_enrollments.apply(args=(self.course_id_string,
+                                           self.emails))
+
+        self.assertEqual(self.mock_send_mail_to_student.call_count, 2)
+        self.assertEqual(mock_apply_async.call_count, 1)
+        args, kwargs = mock_apply_async.call_args
+        self.assertEqual(args[0], (self.course_id_string, self.emails[2:]))
+        self.assertGreater(kwargs['countdown'], 0)
+
+    def test_retry_unsent(self):
+        # On a failure, only the emails not sent yet are retried
+        self.mock_send_mail_to_student.side_effect = [None, IOError]
+        with patch.object(notify_enrollments, 'retry',
+                          side_effect=IOError) as mock_retry:
+            notify_enrollments.apply(args=(self.course_id_string,
+                                           self.emails))
+
+        args, kwargs = mock_retry.call_args
+        self.assertEqual(kwargs['args'],
+                         (self.course_id_string, self.emails[1:]))
+
+    def test_queue_batches(self):
+        with self.settings(WEBHOOK_SETTINGS={'edx_shopify': {
+                'email_batch_size': 2,
+                'email_queue': 'edx.shopify.email'}}), \
+                patch.object(notify_enrollments,
+                             'apply_async') as mock_apply_async:
+            queue_enrollment_emails(self.course_id_string, self.emails)
+
+        self.assertEqual(
+            mock_apply_async.call_args_list,
+            [(((self.course_id_string, self.emails[:2]),),
+              {'queue': 'edx.shopify.email'}),
+             (((self.course_id_string, self.emails[2:]),),
+              {'queue': 'edx.shopify.email'})])
@@ -1,16 +1,28 @@
-import json
-
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.http import Http404
 from django.core.exceptions import ValidationError
+from openedx.core.djangoapps.lang_pref import LANGUAGE_KEY
+from openedx.core.djangoapps.user_api.models import UserPreference
+from student.models import UserProfile
 
 # We need this in order to mock.patch get_course_by_id
 from edx_shopify import utils
 
 # We also import these for convenience
+from edx_shopify.cache import course_cache, email_params_cache
 from edx_shopify.utils import hmac_is_valid, record_order
 from edx_shopify.utils import auto_enroll_email
 from edx_shopify.utils import process_order, process_line_item
+from edx_shopify.utils import group_line_items, record_order_items
+from edx_shopify.payload import load_order, parse_order
+from edx_shopify.utils import process_line_items
+from edx_shopify.utils import chunk_line_items, finish_order
+from edx_shopify.utils import fail_order_items
+from edx_shopify.utils import get_email_languages, get_email_users
+from edx_shopify.utils import get_course_email_params
 
 from edx_shopify.models import Order, OrderItem
 
@@ -52,12 +64,12 @@ class RecordOrderTest(ShopifyTestCase):
     def test_record_order(self):
         # Make sure the order gets created, and that its ID matches
         # that in the payload
-        order1, created1 = record_order(self.json_payload)
+        order1, created1 = record_order(self.order_data)
         self.assertTrue(created1)
         self.assertEqual(order1.id, self.json_payload['id'])
         # Try to create the order again, make sure we get a reference
         # instead
-        order2, created2 = record_order(self.json_payload)
+        order2, created2 = record_order(self.order_data)
         self.assertFalse(created2)
         self.assertEqual(order1, order2)
 
@@ -69,7 +81,7 @@ class ProcessOrderTest(ShopifyTestCase):
         self.setup_course()
 
     def test_valid_order(self):
-        order, created = record_order(self.json_payload)
+        order, created = record_order(self.order_data)
 
         mock_get_course_by_id = Mock(return_value=self.course)
         mock_get_email_params = Mock(return_value=self.email_params)
@@ -78,26 +90,344 @@ class ProcessOrderTest(ShopifyTestCase):
                             get_course_by_id=mock_get_course_by_id,
                             get_email_params=mock_get_email_params,
                             enroll_email=mock_enroll_email):
-            process_order(order, self.json_payload)
+            process_order(order, self.order_data.line_items)
 
         self.assertEqual(order.status, Order.PROCESSED)
 
+    def test_duplicate_claim(self):
+        # Two workers handed the same order: only the first one to
+        # claim it may process it, even though both loaded it while
+        # it was UNPROCESSED
+        order, created = record_order(self.order_data)
+        duplicate = Order.objects.get(id=order.id)
+
+        mock_enroll_email = Mock()
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            enroll_email=mock_enroll_email):
+            process_order(order, self.order_data.line_items)
+
+            # The losing claim costs a single, conditional UPDATE
+            with self.assertNumQueries(1):
+                self.assertIsNone(process_order(duplicate,
+                                                self.order_data.line_items))
+
+        self.assertEqual(mock_enroll_email.call_count, 2)
+        self.assertEqual(Order.objects.get(id=order.id).status,
+                         Order.PROCESSED)
+
+    def test_resume(self):
+        order, created = record_order(self.order_data)
+        Order.objects.filter(id=order.id).update(status=Order.PROCESSING,
+                                                 claimed_by='task-1')
+
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            enroll_email=Mock()):
+            # A PROCESSING order is only picked up when resuming, and
+            # only under the claim it is PROCESSING under
+            self.assertIsNone(process_order(order,
+                                            self.order_data.line_items,
+                                            claim='task-1'))
+            self.assertIsNone(process_order(order,
+                                            self.order_data.line_items,
+                                            resume=True,
+                                            claim='task-2'))
+            process_order(order, self.order_data.line_items,
+                          resume=True, claim='task-1')
+
+        self.assertEqual(Order.objects.get(id=order.id).status,
+                         Order.PROCESSED)
+
     def test_invalid_sku(self):
         # Make sure the order gets created, and that its ID matches
         # that in the payload
         fixup_payload = self.raw_payload.replace("course-v1:org+course+run1",
                                                  "course-v1:org+nosuchcourse+run1")  # noqa: E501
-        fixup_json_payload = json.loads(fixup_payload)
-        order, created = record_order(fixup_json_payload)
+        fixup_order_data = parse_order(fixup_payload)
+        order, created = record_order(fixup_order_data)
 
         # Non-existent course should raise a 404
         with self.assertRaises(Http404):
-            process_order(order, fixup_json_payload)
+            process_order(order, fixup_order_data.line_items)
 
         # At this stage, the order is still PROCESSING -- it's the
         # task failure handler's job to set the status to ERROR
         self.assertEqual(order.status, Order.PROCESSING)
 
+    def test_batched_order(self):
+        # Several seats for the same course should be enrolled in one
+        # batch, loading the course and the email parameters only once
+        data = dict(self.json_payload)
+        data['line_items'] = [
+            {"properties": [{"name": "email",
+                             "value": "learner%d@example.com" % i}],
+             "sku": "course-v1:org+course+run1"}
+            for i in range(5)
+        ]
+        # A duplicate line item must not be enrolled twice
+        data['line_items'].append(data['line_items'][0])
+        order, created = record_order(load_order(data))
+
+        mock_get_course_by_id = Mock(return_value=self.course)
+        mock_get_email_params = Mock(return_value=self.email_params)
+        mock_enroll_email = Mock()
+        mock_send_mail_to_student = Mock()
+        with patch.multiple(utils,
+                            get_course_by_id=mock_get_course_by_id,
+                            get_email_params=mock_get_email_params,
+                            enroll_email=mock_enroll_email,
+                            send_mail_to_student=mock_send_mail_to_student):
+            process_order(order,
+                          load_order(data).line_items,
+                          send_email=True)
+
+        mock_get_course_by_id.assert_called_once_with(self.ck)
+        mock_get_email_params.assert_called_once_with(self.course,
+                                                      True,
+                                                      secure=True)
+        self.assertEqual(mock_enroll_email.call_count, 5)
+        # Students are emailed once the enrollments are committed, not
+        # as part of them
+        for args, kwargs in mock_enroll_email.call_args_list:
+            self.assertFalse(kwargs['email_students'])
+        self.assertEqual(mock_send_mail_to_student.call_count, 5)
+        self.assertEqual(order.status, Order.PROCESSED)
+        self.assertEqual(
+            OrderItem.objects.filter(order=order,
+                                     status=OrderItem.PROCESSED).count(),
+            5)
+
+    def test_deferred_notification(self):
+        # With a notify callback, students are enrolled without email,
+        # and the callback receives the enrolled emails per course
+        order, created = record_order(self.order_data)
+
+        mock_get_email_params = Mock(return_value=self.email_params)
+        mock_enroll_email = Mock()
+        mock_notify = Mock()
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            get_email_params=mock_get_email_params,
+                            enroll_email=mock_enroll_email):
+            process_order(order,
+                          self.order_data.line_items,
+                          send_email=True,
+                          notify=mock_notify)
+
+        self.assertFalse(mock_get_email_params.called)
+        for args, kwargs in mock_enroll_email.call_args_list:
+            self.assertFalse(kwargs['email_students'])
+        self.assertEqual(mock_notify.call_args_list,
+                         [(('course-v1:org+course+run1',
+                            ['learner@example.com']),),
+                          (('course-v1:org+course+run2',
+                            ['learner@example.com']),)])
+
+    def test_failed_batch(self):
+        # If the batch for the second course fails halfway through,
+        # its changes are rolled back, while the first course's are
+        # kept (and only its students notified)
+        data = dict(self.json_payload)
+        data['line_items'] = [
+            {"properties": [{"name": "email",
+                             "value": "learner%d@example.com" % i}],
+             "sku": "course-v1:org+course+run%d" % (1 + i // 2)}
+            for i in range(4)
+        ]
+        order, created = record_order(load_order(data))
+
+        mock_enroll_email = Mock(side_effect=[None, None, None, Http404])
+        mock_notify = Mock()
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            enroll_email=mock_enroll_email):
+            with self.assertRaises(Http404):
+                process_order(order,
+                              load_order(data).line_items,
+                              send_email=True,
+                              notify=mock_notify)
+
+        self.assertEqual(
+            dict(OrderItem.objects.filter(order=order).values_list('email',
+                                                                   'status')),
+            {'learner0@example.com': OrderItem.PROCESSED,
+             'learner1@example.com': OrderItem.PROCESSED,
+             'learner2@example.com': OrderItem.UNPROCESSED,
+             'learner3@example.com': OrderItem.UNPROCESSED})
+        self.assertEqual(mock_notify.call_args_list,
+                         [(('course-v1:org+course+run1',
+                            ['learner0@example.com',
+                             'learner1@example.com']),)])
+        self.assertEqual(Order.objects.get(id=order.id).status,
+                         Order.PROCESSING)
+
+    def test_failed_batch_email(self):
+        # Without a notify callback, students are emailed after the
+        # commit, and only about the enrollments that were kept
+        data = dict(self.json_payload)
+        data['line_items'] = [
+            {"properties": [{"name": "email",
+                             "value": "learner%d@example.com" % i}],
+             "sku": "course-v1:org+course+run%d" % (1 + i // 2)}
+            for i in range(4)
+        ]
+        order, created = record_order(load_order(data))
+
+        mock_send_mail_to_student = Mock()
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            get_email_params=Mock(
+                                return_value=self.email_params),
+                            enroll_email=Mock(side_effect=[None, None,
+                                                           None, Http404]),
+                            send_mail_to_student=mock_send_mail_to_student):
+            with self.assertRaises(Http404):
+                process_order(order,
+                              load_order(data).line_items,
+                              send_email=True)
+
+        self.assertEqual(
+            [args[0] for args, kwargs in
+             mock_send_mail_to_student.call_args_list],
+            ['learner0@example.com', 'learner1@example.com'])
+
+    def test_group_line_items(self):
+        groups = group_line_items(self.order_data.line_items)
+        self.assertEqual(list(groups.items()),
+                         [('course-v1:org+course+run1',
+                           ['learner@example.com']),
+                          ('course-v1:org+course+run2',
+                           ['learner@example.com'])])
+
+
+class BulkOrderItemTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_course()
+
+    def make_order(self, order_id, count):
+        data = dict(self.json_payload)
+        data['id'] = order_id
+        data['line_items'] = [
+            {"properties": [{"name": "email",
+                             "value": "learner%d@example.com" % i}],
+             "sku": "course-v1:org+course+run1"}
+            for i in range(count)
+        ]
+        order, created = record_order(load_order(data))
+        return order, data
+
+    def process(self, order, data):
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            enroll_email=Mock()):
+            process_order(order, load_order(data).line_items)
+
+    def test_constant_query_count(self):
+        # The number of queries must not depend on the number of line
+        # items in the order
+        order, data = self.make_order(50, 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.process(order, data)
+        baseline = len(queries)
+
+        order, data = self.make_order(51, 50)
+        with self.assertNumQueries(baseline):
+            self.process(order, data)
+
+        self.assertEqual(
+            OrderItem.objects.filter(order=order,
+                                     status=OrderItem.PROCESSED).count(),
+            50)
+
+    def test_record_order_items(self):
+        order, data = self.make_order(52, 3)
+        groups = group_line_items(load_order(data).line_items)
+        OrderItem.objects.create(order=order,
+                                 sku='course-v1:org+course+run1',
+                                 email='learner0@example.com',
+                                 status=OrderItem.PROCESSED)
+
+        # One query to fetch the existing item, one to insert the rest
+        with self.assertNumQueries(2):
+            statuses = record_order_items(order, groups)
+
+        self.assertEqual(statuses,
+                         {('course-v1:org+course+run1',
+                           'learner0@example.com'): OrderItem.PROCESSED,
+                          ('course-v1:org+course+run1',
+                           'learner1@example.com'): OrderItem.UNPROCESSED,
+                          ('course-v1:org+course+run1',
+                           'learner2@example.com'): OrderItem.UNPROCESSED})
+        self.assertEqual(OrderItem.objects.filter(order=order).count(), 3)
+
+    def test_partial_failure(self):
+        # If an enrollment fails, the items enrolled before it are
+        # still marked as processed
+        order, data = self.make_order(53, 3)
+        groups = group_line_items(load_order(data).line_items)
+        record_order_items(order, groups)
+
+        mock_enroll_email = Mock(side_effect=[None, Http404])
+        with patch.multiple(utils,
+                            get_course_by_id=Mock(return_value=self.course),
+                            enroll_email=mock_enroll_email):
+            with self.assertRaises(Http404):
+                process_line_items(order,
+                                   'course-v1:org+course+run1',
+                                   groups['course-v1:org+course+run1'])
+
+        self.assertEqual(
+            list(OrderItem.objects.filter(
+                order=order,
+                status=OrderItem.PROCESSED).values_list('email', flat=True)),
+            ['learner0@example.com'])
+
+
+class ChunkedOrderTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.order, created = record_order(self.order_data)
+
+    def test_chunk_line_items(self):
+        line_items = [('b', 'learner1@example.com'),
+                      ('a', 'learner1@example.com'),
+                      ('b', 'learner2@example.com'),
+                      ('b', 'learner1@example.com'),
+                      ('a', 'learner2@example.com')]
+        self.assertEqual(chunk_line_items(line_items, 3),
+                         [[('b', 'learner1@example.com'),
+                           ('b', 'learner2@example.com'),
+                           ('a', 'learner1@example.com')],
+                          [('a', 'learner2@example.com')]])
+
+    def test_finish_order(self):
+        groups = group_line_items(self.order_data.line_items)
+        record_order_items(self.order, groups)
+        finish_order(self.order)
+        self.assertEqual(self.order.status, Order.ERROR)
+
+        OrderItem.objects.filter(order=self.order).update(
+            status=OrderItem.PROCESSED)
+        finish_order(self.order)
+        self.assertEqual(self.order.status, Order.PROCESSED)
+
+    def test_fail_order_items(self):
+        groups = group_line_items(self.order_data.line_items)
+        record_order_items(self.order, groups)
+        OrderItem.objects.filter(sku='course-v1:org+course+run1').update(
+            status=OrderItem.PROCESSED)
+
+        fail_order_items(self.order, self.order_data.line_items)
+
+        self.assertEqual(
+            dict(OrderItem.objects.values_list('sku', 'status')),
+            {'course-v1:org+course+run1': OrderItem.PROCESSED,
+             'course-v1:org+course+run2': OrderItem.ERROR})
+
 
 class ProcessLineItemTest(ShopifyTestCase):
 
@@ -184,6 +514,26 @@ class EmailEnrollmentTest(ShopifyTestCase):
     def setUp(self):
         self.setup_course()
 
+    def test_course_cached(self):
+        # Enrolling several emails in the same course should only
+        # load the course from the modulestore once
+        mock_get_course_by_id = Mock(return_value=self.course)
+        mock_enroll_email = Mock()
+
+        with patch.multiple(utils,
+                            get_course_by_id=mock_get_course_by_id,
+                            enroll_email=mock_enroll_email):
+            for address in ['johndoe@example.com',
+                            'janedoe@example.com']:
+                auto_enroll_email(self.course_id_string,
+                                  address,
+                                  send_email=False)
+
+        mock_get_course_by_id.assert_called_once_with(self.ck)
+        self.assertEqual(mock_enroll_email.call_count, 2)
+        self.assertEqual(course_cache.stats()['hits'], 1)
+        self.assertEqual(course_cache.stats()['misses'], 1)
+
     def test_enrollment_failure(self):
         # Enrolling in a non-existent course (or run) should fail, no
         # matter whether the user exists or not
@@ -250,3 +600,40 @@ class EmailEnrollmentTest(ShopifyTestCase):
                                                       email_students=True,
                                                       email_params=self.email_params,  # noqa: E501
                                                       language=None)
+
+    def test_email_languages(self):
+        # Languages and users for any number of emails take one query
+        # each
+        emails = ['learner%d@example.com' % i for i in range(10)]
+        for i, email in enumerate(emails[:5]):
+            user = User.objects.create(username='learner%d' % i,
+                                       email=email)
+            UserProfile.objects.create(user=user, name='Learner %d' % i)
+            if i % 2:
+                UserPreference.objects.create(user=user,
+                                              key=LANGUAGE_KEY,
+                                              value='de')
+
+        with self.assertNumQueries(1):
+            languages = get_email_languages(emails)
+        self.assertEqual(languages, {emails[1]: 'de', emails[3]: 'de'})
+
+        with self.assertNumQueries(1):
+            users = get_email_users(emails)
+            self.assertEqual(sorted(users), emails[:5])
+            self.assertEqual(users[emails[2]].profile.name, 'Learner 2')
+
+    def test_email_params_cached(self):
+        # Email parameters are only computed once per course, and each
+        # caller gets its own copy
+        mock_get_email_params = Mock(return_value=self.email_params)
+        with patch.object(utils, 'get_email_params', mock_get_email_params):
+            params = get_course_email_params(self.course)
+            params['email_address'] = 'learner@example.com'
+            self.assertEqual(get_course_email_params(self.course),
+                             self.email_params)
+
+        mock_get_email_params.assert_called_once_with(self.course,
+                                                      True,
+                                                      secure=True)
+        self.assertEqual(email_params_cache.stats()['hits'], 1)
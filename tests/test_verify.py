@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from django.test import TestCase, override_settings
+
+from edx_shopify.verify import WebhookVerifier, get_keys, get_verifier
+
+
+class WebhookVerifierTest(TestCase):
+
+    # Signatures of the body 'world' under the keys 'hello' and 'foo'
+    HELLO_SIGNATURE = '8ayXAutfryPKKRpNxG3t3u4qeMza8KQSvtdxTP/7HMQ='
+    FOO_SIGNATURE = 'Ay9MfRDGVAr7Er73ous69ragCFK4smbZfveeN31rH7U='
+
+    def test_single_key(self):
+        verifier = WebhookVerifier(['hello'])
+        self.assertTrue(verifier.is_valid(b'world', self.HELLO_SIGNATURE))
+        self.assertFalse(verifier.is_valid(b'world!', self.HELLO_SIGNATURE))
+        self.assertFalse(verifier.is_valid(b'world', self.FOO_SIGNATURE))
+
+        # The keyed state must be reusable
+        self.assertTrue(verifier.is_valid(b'world', self.HELLO_SIGNATURE))
+
+    def test_several_keys(self):
+        verifier = WebhookVerifier(['foo', 'hello'])
+        self.assertTrue(verifier.is_valid(b'world', self.HELLO_SIGNATURE))
+        self.assertTrue(verifier.is_valid(b'world', self.FOO_SIGNATURE))
+        self.assertFalse(verifier.is_valid(b'bar', self.FOO_SIGNATURE))
+
+    def test_invalid_signature(self):
+        verifier = WebhookVerifier(['hello'])
+        self.assertFalse(verifier.is_valid(b'world', u'\xe9'))
+        self.assertFalse(verifier.is_valid(b'world', ''))
+
+    def test_no_keys(self):
+        self.assertFalse(WebhookVerifier([]).is_valid(b'world', ''))
+
+    def test_keys_from_settings(self):
+        self.assertEqual(get_keys(), ['foobar'])
+
+        with override_settings(WEBHOOK_SETTINGS={'edx_shopify': {
+                'api_key': 'hello',
+                'api_keys': ['foo', 'hello']}}):
+            self.assertEqual(get_keys(), ['foo', 'hello'])
+            verifier = get_verifier()
+            self.assertIs(get_verifier(), verifier)
+            self.assertTrue(verifier.is_valid(b'world', self.FOO_SIGNATURE))
+
+        # The verifier is rebuilt when the settings change
+        self.assertFalse(get_verifier().is_valid(b'world',
+                                                 self.FOO_SIGNATURE))
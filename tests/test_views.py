@@ -8,6 +8,7 @@ from django.test import Client
 
 # We need this in order to mock.patch get_course_by_id
 from edx_shopify import utils
+from edx_shopify.models import Order
 
 from . import ShopifyTestCase
 
@@ -17,6 +18,14 @@ except ImportError:
     from mock import Mock, patch
 
 
+def sign(payload):
+    "Return the webhook signature of a payload."
+    conf = settings.WEBHOOK_SETTINGS['edx_shopify']
+    return base64.b64encode(hmac.new(conf['api_key'],
+                                     payload,
+                                     hashlib.sha256).digest())
+
+
 class TestOrderCreation(ShopifyTestCase):
 
     def setUp(self):
@@ -85,6 +94,19 @@ class TestOrderCreation(ShopifyTestCase):
                                     HTTP_X_SHOPIFY_SHOP_DOMAIN='nonexistant-domain.com')  # noqa: E501
         self.assertEqual(response.status_code, 403)
 
+    def test_malformed_payload(self):
+        # A correctly signed payload lacking line item emails must be
+        # rejected at ingress
+        payload = self.raw_payload.replace('"name": "email"',
+                                           '"name": "mail"')
+        response = self.client.post('/shopify/order/create',
+                                    payload,
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=sign(payload),
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
     def test_valid_order(self):
         response = self.client.post('/shopify/order/create',
                                     self.raw_payload,